@@ -7,17 +7,40 @@
 # TODO: Refer `ContourWidget.py` to add some interactive operation
 
 import os
+import collections
 import copy
 import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import shutil
+import tempfile
+import threading
 # import sys
 import time
 import urllib
+import zlib
 import qt
 import slicer
 import ctk
 import numpy as np
-# from multiprocessing import Pool
+import multiprocessing
+from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
+try:
+    import Queue as queue  # Python 2
+except ImportError:
+    import queue
+try:
+    import cPickle as pickle  # Python 2
+except ImportError:
+    import pickle
+try:
+    from threadpoolctl import threadpool_limits  # optional, caps BLAS threads
+except ImportError:
+    threadpool_limits = None
 
 import vtk
 from vtk.util import numpy_support
@@ -37,6 +60,125 @@ logging.basicConfig(level=logging.INFO)
 # logging.basicConfig(level=logging.WARNING)
 
 
+#
+# NRRD `type` field --> NumPy type, see `DivideImageLogic.readNrrdHeader`
+#
+_NRRD_TYPES = {}
+for _names, _type in (
+        (('signed char', 'int8', 'int8_t'), 'i1'),
+        (('uchar', 'unsigned char', 'uint8', 'uint8_t'), 'u1'),
+        (('short', 'short int', 'signed short', 'signed short int', 'int16',
+          'int16_t'), 'i2'),
+        (('ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'), 'u2'),
+        (('int', 'signed int', 'int32', 'int32_t'), 'i4'),
+        (('uint', 'unsigned int', 'uint32', 'uint32_t'), 'u4'),
+        (('longlong', 'long long', 'long long int', 'signed long long',
+          'signed long long int', 'int64', 'int64_t'), 'i8'),
+        (('ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64',
+          'uint64_t'), 'u8'),
+        (('float',), 'f4'),
+        (('double',), 'f8')):
+    for _name in _names:
+        _NRRD_TYPES[_name] = _type
+
+
+# Bits of a byte spread three apart, `abc` --> `00a00b00c`, for Morton keys
+_MORTON_SPREAD = np.zeros(256, dtype=np.int64)
+for _bit in range(8):
+    _MORTON_SPREAD |= ((np.arange(256) >> _bit) & 1) << (3 * _bit)
+
+try:
+    _stringTypes = basestring  # Python 2
+except NameError:
+    _stringTypes = str
+
+
+#
+# Memoisation of `DivideImageLogic` methods in `DivideImageLogic.resultCache`
+#
+def _hashArguments(sha1, value):
+    """
+    Feed the content of an argument into a SHA-1, arrays by their bytes
+    """
+    if isinstance(value, np.ndarray):
+        sha1.update(repr((value.dtype.str, value.shape)).encode('ascii'))
+        sha1.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        sha1.update(("%s%d" % (type(value).__name__, len(value))).encode('ascii'))
+        for item in value:
+            _hashArguments(sha1, item)
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            _hashArguments(sha1, (key, value[key]))
+    else:
+        sha1.update(repr(value).encode('utf-8'))
+
+
+def _memoized(function):
+    """
+    Memoise a method by the content of its arguments. Every call gets its
+    own copy of the result, so it can be modified freely.
+    NOTE: the default values are not part of the key, `f(a)` and
+    `f(a, b=default)` are two entries
+    """
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        cache = DivideImageLogic.resultCache
+        if cache is None:
+            return function(self, *args, **kwargs)
+
+        sha1 = hashlib.sha1(function.__name__.encode('ascii'))
+        _hashArguments(sha1, (args, kwargs))
+        key = sha1.hexdigest()
+        try:
+            return copy.deepcopy(cache.get(key))
+        except KeyError:
+            result = function(self, *args, **kwargs)
+            cache.put(key, copy.deepcopy(result))
+            return result
+
+    return wrapper
+
+
+#
+# Worker of `DivideImageLogic.fitBlocks`, module level to be picklable
+#
+def _initFitWorker():
+    """
+    Reseed the RNG of a worker process, a forked worker inherits the state
+    of its parent, drop the inherited result cache, its results go back to
+    the parent, and keep its BLAS to one thread if `threadpoolctl` exists
+    """
+    np.random.seed()
+    DivideImageLogic.resultCache = None
+    if threadpool_limits is not None:
+        threadpool_limits(limits=1)
+
+
+def _getBlockK(seed, sn):
+    """
+    `k` of one block's fitting from `seed + sn`, so it does not depend on the
+    process, None without a seed
+    """
+    if seed is not None:
+        return np.random.RandomState((seed + int(sn)) % (1 << 32)).randint(4, 10000)
+
+
+def _fitBlockChunk(args):
+    """
+    Fit a chunk of blocks in a worker process
+    @param args     (chunk, dtype, solver, seed), chunk is a list of (sn, coords)
+    @return list    (sn, vector) of every block in the chunk
+    """
+    chunk, dtype, solver, seed = args
+    logic = DivideImageLogic()
+    results = []
+    for sn, coords in chunk:
+        results.append((sn, logic.implicitFitting(coords, dtype=dtype, solver=solver,
+                                                  k=_getBlockK(seed, sn))))
+    return results
+
+
 #
 # A subclass of `dict` to make dict behave like class
 #
@@ -95,14 +237,18 @@ class SubMedicalImage(object):
       - It can has a `toNdarray` method
       - Anxiliary functions can be added for debugging, such as rendering
     """
+    __slots__ = ('_imageData', '_voxelType', '_bigImage', 'imageArray', '_init', '_sn',
+                 '_index', '_voi', '_isValid', 'dims', 'shape', '_extent')
+
     def __init__(self,   # parent,
                  l=3, w=4, h=6,  # length, width, height
                  voxelType=vtk.VTK_UNSIGNED_CHAR):
 
-        imageData = vtk.vtkImageData()
-        imageData.SetDimensions(l, w, h)
-        imageData.AllocateScalars(voxelType, 1)
-        self.imageData = imageData
+        # The `vtkImageData` is allocated when it is first used, see `imageData`
+        self._imageData = None
+        self._voxelType = voxelType
+        self._bigImage = None
+        self.imageArray = None
 
         self._init = False
         self._sn = 0
@@ -113,8 +259,18 @@ class SubMedicalImage(object):
         self.shape = (h, w, l)  # for NumPy
         self._extent = (0, 1) * 3
 
-    def __del__(self):
-        del self.imageData
+    @property
+    def imageData(self):
+        if self._imageData is None:
+            imageData = vtk.vtkImageData()
+            imageData.SetDimensions(self.dims)
+            imageData.AllocateScalars(self._voxelType, 1)
+            self._imageData = imageData
+        return self._imageData
+
+    @imageData.setter
+    def imageData(self, imageData):
+        self._imageData = imageData
 
     #
     # Getter & Setter
@@ -182,9 +338,7 @@ class SubMedicalImage(object):
         if imageData is None or imageArray is None:
             raise TypeError("Initialise the image first!")
 
-        shape = list(imageData.GetDimensions())
-        shape.reverse()
-        ndarray = vtk.util.numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
+        ndarray = DivideImageLogic().ndarrayFromVtkImageData(imageData)
 
         # logging.debug("Corresponding test of vtkImageData and NumPy array.")
         if np.array_equal(imageArray, ndarray):
@@ -414,6 +568,1253 @@ class SubMedicalImage(object):
         iren.Start()
 
 
+#
+# class: `IntegralVolume`
+#
+class IntegralVolume(object):
+    """
+    Summed-area table of the in-range mask of a big matrix.
+    - It is built once for a volume and a grey value range
+    - The number of in-range points of any box comes from 8 lookups,
+      so re-dividing with another step or overlap does not rescan the volume
+    - `table[i, j, k]` is the number of in-range points in
+      `bigMatrix[:i, :j, :k]`, hence `table` is 1 larger on every axis
+    """
+    def __init__(self, bigMatrix, range=[90, 100]):
+
+        if bigMatrix.ndim != 3:
+            raise TypeError("a 3D array is required")
+
+        shape = bigMatrix.shape
+        dtype = np.int32 if bigMatrix.size < 2 ** 31 else np.int64
+
+        table = np.zeros([n + 1 for n in shape], dtype=dtype)
+        inner = table[1:, 1:, 1:]
+        inner[...] = (bigMatrix >= range[0]) & (bigMatrix <= range[1])
+        for axis in (0, 1, 2):
+            np.cumsum(inner, axis=axis, out=inner)
+
+        self.table = table
+        self.shape = shape
+        self.range = tuple(range)
+
+    def boxCount(self, voi):
+        """
+        Number of in-range points in one box
+        @param voi      (i0, i1, j0, j1, k0, k1), same as `_getSubImageInfo`
+        @return int
+        """
+        i0, i1, j0, j1, k0, k1 = voi
+        t = self.table
+        return int(t[i1, j1, k1] - t[i0, j1, k1] - t[i1, j0, k1] - t[i1, j1, k0] +
+                   t[i0, j0, k1] + t[i0, j1, k0] + t[i1, j0, k0] - t[i0, j0, k0])
+
+    def gridCounts(self, starts, stops):
+        """
+        Number of in-range points of every box of a separable grid
+        @param starts   3 arrays, starts of the boxes along every axis
+        @param stops    3 arrays, stops of the boxes along every axis
+        @return ndarray (len(starts[0]), len(starts[1]), len(starts[2]))
+        """
+        i0, j0, k0 = [np.asarray(s) for s in starts]
+        i1, j1, k1 = [np.asarray(s) for s in stops]
+        t = self.table
+
+        def lookup(i, j, k):
+            return t[np.ix_(i, j, k)].astype(np.int64)
+
+        return (lookup(i1, j1, k1) - lookup(i0, j1, k1) - lookup(i1, j0, k1) -
+                lookup(i1, j1, k0) + lookup(i0, j0, k1) + lookup(i0, j1, k0) +
+                lookup(i1, j0, k0) - lookup(i0, j0, k0))
+
+    def blockCounts(self, step=[40] * 3, overlap=[0] * 3):
+        """
+        Number of in-range points and voxels of every block, divided in the
+        same way as `_getSubImageInfo`
+        @return 1       (nz, ny, nx) number of in-range points
+        @return 2       (nz, ny, nx) number of voxels
+        """
+        starts = [np.arange(0, n, s) for n, s in zip(self.shape, step)]
+        stops = [np.minimum(b + s + o, n)
+                 for b, s, o, n in zip(starts, step, overlap, self.shape)]
+
+        counts = self.gridCounts(starts, stops)
+        sizes = [b - a for a, b in zip(starts, stops)]
+        numItems = (sizes[0][:, None, None] * sizes[1][None, :, None] *
+                    sizes[2][None, None, :])
+
+        return counts, numItems
+
+    def isValidGrid(self, step=[40] * 3, overlap=[0] * 3, ratio=0.1):
+        """
+        Validity of every block, the same standard as `isValidMatrix`
+        @return ndarray (nz, ny, nx) boolean
+        """
+        counts, numItems = self.blockCounts(step, overlap)
+        return counts >= ratio * numItems
+
+
+#
+# class: `BlockHistogram`
+#
+class BlockHistogram(object):
+    """
+    Cumulative grey value histogram of every block of a big matrix.
+    - It is built in one pass, one slab of blocks at a time
+    - Validity for any grey value range and ratio is answered from the
+      histograms, the voxels are not touched again
+    - Integer data spanning no more than `numBins` grey values gets one bin
+      per value and the counts are exact. Otherwise the values are quantised
+      and a range is rounded outwards to whole bins.
+    - `cumulative[i, j, k, b]` is the number of points of block (i, j, k)
+      in the bins before `b`
+    """
+    def __init__(self, bigMatrix, step=[40] * 3, numBins=256):
+
+        if bigMatrix.ndim != 3:
+            raise TypeError("a 3D array is required")
+
+        shape = bigMatrix.shape
+        step = [int(s) for s in step]
+        grid = [-(-n // s) for n, s in zip(shape, step)]  # ceil division
+
+        valueMin = bigMatrix.min()
+        valueMax = bigMatrix.max()
+        self.isInteger = np.issubdtype(bigMatrix.dtype, np.integer)
+        if self.isInteger:
+            valueMin, valueMax = int(valueMin), int(valueMax)
+            binWidth = -(-(valueMax - valueMin + 1) // numBins)
+        else:
+            valueMin, valueMax = float(valueMin), float(valueMax)
+            binWidth = (valueMax - valueMin) / numBins or 1.0
+
+        self.shape = shape
+        self.step = step
+        self.grid = grid
+        self.numBins = numBins
+        self.valueMin = valueMin
+        self.valueMax = valueMax
+        self.binWidth = binWidth
+
+        # Block id of every voxel in a slab, without the slab axis
+        blockJ = np.arange(shape[1]) // step[1]
+        blockK = np.arange(shape[2]) // step[2]
+        planeIds = (blockJ[:, None] * grid[2] + blockK[None, :]) * numBins
+
+        numPlaneBins = grid[1] * grid[2] * numBins
+        cumulative = np.zeros(grid + [numBins + 1], dtype=np.int32)
+        for i in range(grid[0]):
+            slab = bigMatrix[i * step[0]:(i + 1) * step[0]]
+            bins = self._getBins(slab)
+            hist = np.bincount((bins + planeIds).ravel(), minlength=numPlaneBins)
+            np.cumsum(hist.reshape(grid[1], grid[2], numBins), axis=-1,
+                      out=cumulative[i, :, :, 1:])
+
+        self.cumulative = cumulative
+
+    def _getBins(self, values):
+        if self.isInteger:
+            bins = (values.astype(np.int64) - self.valueMin) // self.binWidth
+        else:
+            bins = np.floor((values - self.valueMin) / self.binWidth).astype(np.int64)
+        return np.clip(bins, 0, self.numBins - 1)
+
+    def counts(self, range=[90, 100]):
+        """
+        Number of points in the grey value range of every block
+        @param range    a grey value range, both ends are included
+        @return ndarray (nz, ny, nx)
+        """
+        low, high = range
+        if self.isInteger:
+            low, high = np.ceil(low), np.floor(high)
+        if low > high or high < self.valueMin or low > self.valueMax:
+            return np.zeros(self.grid, dtype=np.int64)
+
+        lowBin, highBin = self._getBins(np.array([low, high]))
+        cumulative = self.cumulative
+        return (cumulative[..., highBin + 1].astype(np.int64) -
+                cumulative[..., lowBin])
+
+    @property
+    def numItems(self):
+        return self.cumulative[..., -1]
+
+    def isValidGrid(self, range=[90, 100], ratio=0.1):
+        """
+        Validity of every block, the same standard as `isValidMatrix`
+        @return ndarray (nz, ny, nx) boolean
+        """
+        return self.counts(range) >= ratio * self.numItems
+
+
+#
+# class: `BlockPointStore`
+#
+class BlockPointStore(object):
+    """
+    In-range points of all blocks of a big matrix, bucketed by block `sn`.
+    - One contiguous coordinate array and one offset array (CSR style),
+      `coords[offsets[sn]:offsets[sn + 1]]` are the points of block `sn`
+    - Coordinates are local to the block, the same as `getCoords`, and kept
+      in the raster order of the block
+    - `sn` is the raster order of the blocks, as in `getValidSubMatrices`
+    """
+    def __init__(self, coords, offsets, grid, step, numItems):
+
+        self.coords = coords
+        self.offsets = offsets
+        self.grid = tuple(grid)
+        self.step = tuple(step)
+        self.numItems = numItems  # number of voxels of every block, by sn
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def getCoords(self, sn):
+        """
+        Points of one block, a view of the store
+        @return ndarray     a n*3 array
+        """
+        return self.coords[self.offsets[sn]:self.offsets[sn + 1]]
+
+    def getIndex(self, sn):
+        return np.unravel_index(sn, self.grid)
+
+    def getOrigin(self, sn):
+        """
+        Position of the first voxel of the block in the big matrix
+        """
+        return np.multiply(self.getIndex(sn), self.step)
+
+    def isValid(self, ratio=0.1):
+        """
+        Validity of every block by sn, the same standard as `getCoords`
+        @return ndarray     1D boolean array
+        """
+        return self.counts >= ratio * self.numItems
+
+
+#
+# class: `RBFTreecode`
+#
+class RBFTreecode(object):
+    """
+    Approximate sum of the biharmonic kernel `sum(w_i * |p - c_i|)` over many
+    centres, close to O(N log N) instead of O(N_centres * N_points).
+    - The centres are kept in an octree, every node knows its weight moments
+    - A node far from a point, `radius < theta * distance`, is replaced by a
+      2nd order expansion of its moments; near nodes are opened, and near
+      leaves are summed exactly
+    - The error of a far node is below `theta ** 3 * sum(|w_i| * |p - c_i|)`
+      over its centres, so `theta` is the cube root of the user-set
+      `tolerance`. The bound is loose, the error is usually far smaller.
+    - It only pays off for thousands of centres
+    """
+    def __init__(self, centres, weights, tolerance=1e-3, leafSize=64):
+
+        centres = np.asarray(centres, dtype=np.float64)
+        weights = np.real(np.asarray(weights)).ravel().astype(np.float64)
+        if len(centres) != len(weights):
+            raise ValueError("A weight is required for every centre")
+
+        self.theta = min(tolerance ** (1 / 3.0), 0.9)
+        self.leafSize = leafSize
+
+        # The centres are reordered so that every node is a contiguous range
+        self.order = np.arange(len(centres))
+        self.centres = centres
+        self.weights = weights
+
+        # Nodes as parallel lists, the root is node 0
+        self.begins, self.ends, self.children = [], [], []
+        self.origins, self.radii, self.moments = [], [], []
+        self._build(0, len(centres))
+
+        self.centres = centres[self.order]
+        self.weights = weights[self.order]
+        self._setMoments()
+
+    def _build(self, begin, end):
+        node = len(self.begins)
+        self.begins.append(begin)
+        self.ends.append(end)
+        self.children.append([])
+
+        points = self.centres[self.order[begin:end]]
+        low, high = points.min(0), points.max(0)
+        if end - begin <= self.leafSize or np.all(high == low):
+            return node
+
+        # Split into octants around the centre of the bounding box
+        middle = (low + high) / 2.0
+        octants = ((points > middle) * [4, 2, 1]).sum(1)
+        sort = np.argsort(octants, kind='mergesort')
+        self.order[begin:end] = self.order[begin:end][sort]
+        bounds = np.searchsorted(octants[sort], np.arange(9)) + begin
+
+        for octant in range(8):
+            if bounds[octant] < bounds[octant + 1]:
+                child = self._build(bounds[octant], bounds[octant + 1])
+                self.children[node].append(child)
+
+        return node
+
+    def _setMoments(self):
+        for begin, end in zip(self.begins, self.ends):
+            points = self.centres[begin:end]
+            weights = self.weights[begin:end]
+            origin = (points.min(0) + points.max(0)) / 2.0
+            delta = points - origin
+
+            self.origins.append(origin)
+            self.radii.append(np.sqrt(np.max(np.sum(delta * delta, axis=1))))
+            # Q0 = sum(w), P = sum(w * delta), S = sum(w * delta * delta.T)
+            self.moments.append((weights.sum(), np.dot(weights, delta),
+                                 np.dot(delta.T * weights, delta)))
+
+    def evaluate(self, points):
+        """
+        @param points   m*3 array
+        @return ndarray m values of `sum(w_i * |p - c_i|)`
+        """
+        points = np.asarray(points, dtype=np.float64)
+        values = np.zeros(len(points))
+        self._evaluate(0, points, np.arange(len(points)), values)
+        return values
+
+    def _evaluate(self, node, points, targets, values):
+        d = points[targets] - self.origins[node]
+        distance = np.sqrt(np.sum(d * d, axis=1))
+        isFar = self.radii[node] < self.theta * distance
+
+        if np.any(isFar):
+            far = d[isFar]
+            farDistance = distance[isFar]
+            Q0, P, S = self.moments[node]
+            dP = np.dot(far, P) / farDistance
+            dSd = np.einsum('ij,jk,ik->i', far, S, far) / farDistance ** 2
+            values[targets[isFar]] += (Q0 * farDistance - dP +
+                                       (np.trace(S) - dSd) / (2 * farDistance))
+
+        near = targets[~isFar]
+        if not len(near):
+            return
+
+        if not self.children[node]:
+            begin, end = self.begins[node], self.ends[node]
+            centres = self.centres[begin:end]
+            for start in range(0, len(near), 4096):
+                chunk = points[near[start:start + 4096]]
+                diffs = [chunk[:, axis, None] - centres[None, :, axis]
+                         for axis in range(3)]
+                exact = np.sqrt(diffs[0] ** 2 + diffs[1] ** 2 + diffs[2] ** 2)
+                values[near[start:start + 4096]] += np.dot(exact, self.weights[begin:end])
+        else:
+            for child in self.children[node]:
+                self._evaluate(child, points, near, values)
+
+
+#
+# class: `PartitionOfUnityFit`
+#
+class PartitionOfUnityFit(object):
+    """
+    One global implicit function blended from independent fits of the blocks.
+    - Every fitted block supports a ball around the centre of its block, the
+      overlap included, and its weight falls to 0 at the ball's boundary
+      with the compactly supported Wendland function (1 - r)^4 (4r + 1)
+    - `f(p) = sum(w_b(p) * f_b(p)) / sum(w_b(p))`, evaluated lazily per
+      query point, only the blocks whose ball contains the point are used
+    - Every block fit is scaled to unit mean gradient on its points, so
+      neighbouring fits agree on the scale of the blend, and `orient` makes
+      the signs of neighbouring fits agree
+    - Points are in voxel coordinates of the big matrix, as `getCoords`
+    """
+    def __init__(self, grid, step=[40] * 3, overlap=[0] * 3):
+
+        self.grid = tuple(grid)
+        self.step = np.asarray(step, dtype=np.float64)
+        self.overlap = np.asarray(overlap, dtype=np.float64)
+        self.radius = 0.6 * np.linalg.norm(self.step + self.overlap)
+
+        self.fitIds = -np.ones(self.grid, dtype=np.int64)
+        self.origins, self.centres = [], []
+        self.data, self.vectors, self.scales = [], [], []
+        self.logic = DivideImageLogic()
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def addFit(self, index, data, vector):
+        """
+        @param index    (i, j, k) of the block
+        @param data     the points fitted, local to the block
+        @param vector   found fitting, see `implicitFitting`
+        """
+        vector = np.real(np.asarray(vector)).ravel()
+
+        _, gradient = self.logic.evaluateRBF(vector, data, data, withGradient=True)
+        norms = np.sqrt(np.sum(gradient * gradient, axis=1))
+        scale = np.mean(norms) or 1.0
+
+        origin = np.multiply(index, self.step)
+        self.fitIds[tuple(index)] = len(self.vectors)
+        self.origins.append(origin)
+        self.centres.append(origin + (self.step + self.overlap) / 2.0)
+        self.data.append(np.asarray(data, dtype=np.float64))
+        self.vectors.append(vector)
+        self.scales.append(scale)
+
+    def _getAgreement(self, fitId, other, margin=2):
+        """
+        How much two fits agree on the sign around their shared data: the
+        sum of the products of their scaled values at the voxels within
+        `margin` of the points of either fit in the overlap of the blocks,
+        grown by `margin`. Only there both fits are close to data, away
+        from it a fit extrapolates and its sign means nothing.
+        @return float   > 0 if they agree, < 0 if one must be flipped
+        """
+        low = np.maximum(self.origins[fitId], self.origins[other]) - margin
+        high = np.minimum(self.origins[fitId] + self.step + self.overlap,
+                          self.origins[other] + self.step + self.overlap) + margin
+        shape = tuple(np.maximum(high - low, 0).astype(int))
+        if not all(shape):
+            return 0.0
+
+        # Voxels near the shared points, the points dilated by `margin`
+        isNear = np.zeros(shape, dtype=bool)
+        for i in (fitId, other):
+            points = np.round(self.data[i] + self.origins[i] - low).astype(int)
+            points = points[np.all((points >= 0) & (points < shape), axis=1)]
+            isNear[tuple(points.T)] = True
+        for axis in range(3):
+            for _ in range(int(margin)):
+                dilated = isNear.copy()
+                lower = [slice(None)] * 3
+                upper = [slice(None)] * 3
+                lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+                dilated[tuple(lower)] |= isNear[tuple(upper)]
+                dilated[tuple(upper)] |= isNear[tuple(lower)]
+                isNear = dilated
+        samples = np.argwhere(isNear) + low
+        if not len(samples):
+            return 0.0
+
+        values, otherValues = [
+            self.logic.evaluateRBF(self.vectors[i], self.data[i],
+                                   samples - self.origins[i]) / self.scales[i]
+            for i in (fitId, other)]
+        return np.dot(values, otherValues)
+
+    def _flip(self, fitId):
+        self.vectors[fitId] = -self.vectors[fitId]
+
+    def orient(self, margin=2):
+        """
+        Make the signs of neighbouring fits agree, the sign of a fit without
+        normals is arbitrary. From the first fit of every connected group,
+        the fits are reached through the face neighbours whose agreement is
+        the strongest first, see `_getAgreement`, so one weak pair does not
+        flip all the fits behind it. A fit is flipped when it disagrees with
+        the fit it is reached from. At last every group is flipped as a whole
+        to be positive next to its points on the side away from their
+        centroid, positive outside for a closed surface.
+        @param margin   see `_getAgreement`
+        """
+        isOriented = np.zeros(len(self), dtype=bool)
+        indices = np.argwhere(self.fitIds >= 0)
+        offsets = np.vstack((np.eye(3, dtype=int), -np.eye(3, dtype=int)))
+        counter = itertools.count()
+
+        for root in indices:
+            rootId = self.fitIds[tuple(root)]
+            if isOriented[rootId]:
+                continue
+
+            # Prim's maximum spanning tree by the strength of the agreement
+            group = []
+            heap = [(0.0, next(counter), rootId, 1.0)]  # (-strength, order, fitId, agreement)
+            while heap:
+                _, _, fitId, agreement = heapq.heappop(heap)
+                if isOriented[fitId]:
+                    continue
+                if agreement < 0:
+                    self._flip(fitId)
+                isOriented[fitId] = True
+                group.append(fitId)
+
+                index = np.floor(self.origins[fitId] / self.step + 0.5).astype(int)
+                for neighbour in index + offsets:
+                    if np.any(neighbour < 0) or np.any(neighbour >= self.grid):
+                        continue
+                    other = self.fitIds[tuple(neighbour)]
+                    if other < 0 or isOriented[other]:
+                        continue
+                    agreement = self._getAgreement(fitId, other, margin)
+                    heapq.heappush(heap, (-abs(agreement), next(counter), other, agreement))
+
+            # Values one voxel off the points, away from the centroid
+            centroid = np.mean(np.vstack([self.data[i] + self.origins[i] for i in group]), 0)
+            outside = 0.0
+            for i in group:
+                direction = self.data[i] + self.origins[i] - centroid
+                direction /= np.maximum(np.sqrt(np.sum(direction * direction, axis=1)),
+                                        1e-12)[:, None]
+                outside += np.sum(self.logic.evaluateRBF(
+                    self.vectors[i], self.data[i], self.data[i] + direction)) / self.scales[i]
+            if outside < 0:
+                for fitId in group:
+                    self._flip(fitId)
+
+    def evaluate(self, points, outside=np.nan):
+        """
+        @param points   m*3 array, voxel coordinates of the big matrix
+        @param outside  value of the points covered by no fitted block
+        @return ndarray m values
+        """
+        points = np.asarray(points, dtype=np.float64)
+        base = np.floor(points / self.step).astype(np.int64)
+        centres = np.asarray(self.centres)
+
+        # Blocks far enough to have the point in its ball
+        reach = np.ceil((self.radius + (self.step + self.overlap) / 2.0) /
+                        self.step).astype(int)
+        pointIds, fitIds, weights = [], [], []
+        for offset in np.ndindex(*(2 * reach + 1)):
+            index = base + (np.asarray(offset) - reach)
+            isInside = np.all((index >= 0) & (index < self.grid), axis=1)
+            fitId = -np.ones(len(points), dtype=np.int64)
+            fitId[isInside] = self.fitIds[tuple(index[isInside].T)]
+
+            candidates = np.flatnonzero(fitId >= 0)
+            r = np.sqrt(np.sum((points[candidates] - centres[fitId[candidates]]) ** 2,
+                               axis=1)) / self.radius
+            isSupported = r < 1
+            r = r[isSupported]
+            pointIds.append(candidates[isSupported])
+            fitIds.append(fitId[candidates[isSupported]])
+            weights.append((1 - r) ** 4 * (4 * r + 1))
+
+        pointIds = np.concatenate(pointIds)
+        fitIds = np.concatenate(fitIds)
+        weights = np.concatenate(weights)
+
+        numerator = np.zeros(len(points))
+        denominator = np.zeros(len(points))
+        order = np.argsort(fitIds, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(fitIds[order])) + 1
+        for group in np.split(order, bounds):
+            if not len(group):
+                continue
+            fitId = fitIds[group[0]]
+            ids = pointIds[group]
+            values = self.logic.evaluateRBF(self.vectors[fitId], self.data[fitId],
+                                            points[ids] - self.origins[fitId])
+            numerator[ids] += weights[group] * values / self.scales[fitId]
+            denominator[ids] += weights[group]
+
+        values = np.full(len(points), outside, dtype=np.float64)
+        isCovered = denominator > 0
+        values[isCovered] = numerator[isCovered] / denominator[isCovered]
+        return values
+
+
+#
+# class: `BlockLayout`
+#
+class BlockLayout(object):
+    """
+    Numbering of the blocks of a grid along a space-filling curve, 'raster'
+    is the sn order of `_getSubImageInfo`. Both directions between an index
+    (i, j, k) and the curve sn are one lookup in a table of the grid.
+    Morton (Z-order) keeps most neighbours close, Hilbert keeps every step
+    between consecutive blocks a face neighbour on cubes of powers of 2.
+    """
+    def __init__(self, grid, order='morton'):
+        self.grid = tuple(int(n) for n in grid)
+        self.order = order
+        self.rasterOf = DivideImageLogic().getBlockOrder(self.grid, order)  # curve --> raster
+        self.curveOf = np.empty_like(self.rasterOf)  # raster --> curve
+        self.curveOf[self.rasterOf] = np.arange(len(self.rasterOf))
+
+    def __len__(self):
+        return len(self.rasterOf)
+
+    def encode(self, index):
+        """
+        @param index        (i, j, k), or a N*3 array of them
+        @return             curve sn
+        """
+        index = np.asarray(index)
+        return self.curveOf[np.ravel_multi_index(index.T, self.grid)]
+
+    def decode(self, sn):
+        """
+        @param sn           curve sn, or an array of them
+        @return             (i, j, k), or a N*3 array of them
+        """
+        return np.transpose(np.unravel_index(self.rasterOf[sn], self.grid))
+
+    def toCurve(self, rasterSns):
+        """
+        Raster sn to curve sn, -1 (no block) is kept
+        """
+        rasterSns = np.asarray(rasterSns)
+        return np.where(rasterSns < 0, -1, self.curveOf[np.maximum(rasterSns, 0)])
+
+    @property
+    def neighbours(self):
+        """
+        N*6 curve sn of the superior, inferior, left, right, anterior and
+        posterior neighbour of every block by curve sn, -1 if none
+        """
+        padded = np.pad(self.curveOf.reshape(self.grid), 1, mode='constant',
+                        constant_values=-1)
+        i, j, k = self.decode(np.arange(len(self))).T + 1
+        return np.column_stack((padded[i - 1, j, k], padded[i + 1, j, k],
+                                padded[i, j - 1, k], padded[i, j + 1, k],
+                                padded[i, j, k - 1], padded[i, j, k + 1]))
+
+
+#
+# class: `BlockRegistry`
+#
+class BlockRegistry(object):
+    """
+    All blocks of a divided volume as one NumPy structured array, a row per
+    block by sn, instead of a Python object per block. 100k blocks take a
+    few MB, and the queries are vectorised over the columns:
+        sn          int64
+        index       3 * int32, (i, j, k)
+        voi         6 * int32, (i0, i1, j0, j1, k0, k1)
+        extent      6 * int32, (k0, k1 - 1, j0, j1 - 1, i0, i1 - 1)
+        isValid     bool
+        numPoints   int64, number of in-range points
+        numItems    int64, number of voxels
+        neighbours  6 * int64, sn of the superior, inferior, left, right,
+                    anterior and posterior neighbour, -1 if none
+    See `DivideImageLogic.getBlockRegistry`
+    """
+    dtype = np.dtype([('sn', np.int64), ('index', np.int32, (3,)),
+                      ('voi', np.int32, (6,)), ('extent', np.int32, (6,)),
+                      ('isValid', np.bool_), ('numPoints', np.int64),
+                      ('numItems', np.int64), ('neighbours', np.int64, (6,))])
+
+    def __init__(self, blockInfo, numPoints, ratio=0.1):
+        """
+        @param blockInfo    see `DivideImageLogic.getBlockInfo`
+        @param numPoints    number of in-range points of every block by sn
+        @param ratio        least ratio of in-range points of a valid block
+        """
+        self.grid = blockInfo.grid
+        records = np.zeros(len(blockInfo.sns), dtype=BlockRegistry.dtype)
+        records['sn'] = blockInfo.sns
+        records['index'] = blockInfo.indices
+        records['voi'] = blockInfo.vois
+        records['extent'] = blockInfo.extents
+        records['neighbours'] = blockInfo.neighbours
+        records['numPoints'] = numPoints
+        records['numItems'] = np.prod(blockInfo.vois[:, 1::2] - blockInfo.vois[:, ::2], axis=1)
+        self.records = records
+        self.setRatio(ratio)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, sn):
+        return self.records[sn]
+
+    def setRatio(self, ratio=0.1):
+        """
+        Revalidate all blocks by another ratio, the same standard as `getCoords`
+        """
+        self.records['isValid'] = self.records['numPoints'] >= ratio * self.records['numItems']
+
+    @property
+    def isValid(self):
+        return self.records['isValid']
+
+    def hasNeighbour(self, mask, outside=False):
+        """
+        Whether any of the 6-neighbours of every block is in `mask`
+        @param mask         boolean array by sn
+        @param outside      whether a missing neighbour beyond the grid counts
+        @return ndarray     boolean array by sn
+        """
+        # The sn -1 of a missing neighbour picks the appended `outside`
+        return np.append(mask, outside)[self.records['neighbours']].any(axis=1)
+
+    def countNeighbours(self, mask, outside=False):
+        """
+        Number of the 6-neighbours of every block in `mask`, see `hasNeighbour`
+        """
+        return np.append(mask, outside)[self.records['neighbours']].sum(axis=1)
+
+    def getBorderBlocks(self, outside=False):
+        """
+        sn of the valid blocks adjacent to an invalid one
+        @param outside      whether the grid boundary counts as invalid
+        """
+        isValid = self.isValid
+        return np.flatnonzero(isValid & self.hasNeighbour(~isValid, outside))
+
+    def getIsolatedBlocks(self):
+        """
+        sn of the valid blocks without any valid neighbour
+        """
+        isValid = self.isValid
+        return np.flatnonzero(isValid & ~self.hasNeighbour(isValid))
+
+
+#
+# class: `ResultCache`
+#
+class ResultCache(object):
+    """
+    LRU of results in memory, bounded by the bytes of their arrays, with an
+    optional on-disk tier. Every result put is also written to the disk
+    tier, so what is evicted from memory is still a disk hit, also in the
+    next session. The disk tier is not bounded, `clear` empties it.
+    `stats` tells how well it is sized.
+    """
+    def __init__(self, maxBytes=256 << 20, path=None):
+        """
+        @param maxBytes     memory bound, by the bytes of the arrays
+        @param path         directory of the disk tier, None for memory only
+        """
+        self.maxBytes = maxBytes
+        self.path = path
+        self.items = collections.OrderedDict()  # key --> (value, numBytes)
+        self.numBytes = 0
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _getSize(value):
+        if isinstance(value, np.ndarray):
+            return value.nbytes
+        if isinstance(value, (list, tuple)):
+            return sum(ResultCache._getSize(item) for item in value)
+        return 64  # a scalar or a small object
+
+    def _getFilePath(self, key):
+        return os.path.join(self.path, key[:2], key + '.pkl')
+
+    def get(self, key):
+        """
+        @return             the cached value, not a copy
+        @raise KeyError     on a miss
+        """
+        with self.lock:
+            if key in self.items:
+                self.items[key] = self.items.pop(key)  # the latest used is the last
+                self.hits += 1
+                return self.items[key][0]
+
+        if self.path is not None and os.path.exists(self._getFilePath(key)):
+            with open(self._getFilePath(key), 'rb') as f:
+                value = pickle.load(f)
+            with self.lock:
+                self.diskHits += 1
+            self._putInMemory(key, value)
+            return value
+
+        with self.lock:
+            self.misses += 1
+        raise KeyError(key)
+
+    def put(self, key, value):
+        if self.path is not None:
+            BlockStore._write(self._getFilePath(key),
+                              pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self._putInMemory(key, value)
+
+    def _putInMemory(self, key, value):
+        numBytes = self._getSize(value)
+        if numBytes > self.maxBytes:  # it would evict everything else
+            return
+
+        with self.lock:
+            if key in self.items:
+                self.numBytes -= self.items.pop(key)[1]
+            self.items[key] = (value, numBytes)
+            self.numBytes += numBytes
+            while self.numBytes > self.maxBytes:
+                _, (_, evictedBytes) = self.items.popitem(last=False)
+                self.numBytes -= evictedBytes
+                self.evictions += 1
+
+    def clear(self, disk=False):
+        """
+        Empty the memory, and the disk tier if `disk`; the counters are reset
+        """
+        with self.lock:
+            self.items.clear()
+            self.numBytes = 0
+            self.hits = self.diskHits = self.misses = self.evictions = 0
+        if disk and self.path is not None and os.path.isdir(self.path):
+            for directory, _, fileNames in os.walk(self.path):
+                for fileName in fileNames:
+                    if fileName.endswith('.pkl'):
+                        os.remove(os.path.join(directory, fileName))
+
+    @property
+    def stats(self):
+        return objdict(hits=self.hits, diskHits=self.diskHits, misses=self.misses,
+                       evictions=self.evictions, numItems=len(self.items),
+                       numBytes=self.numBytes, maxBytes=self.maxBytes)
+
+
+#
+# class: `BlockStore`
+#
+class BlockStore(object):
+    """
+    On-disk cache of a divided volume, keyed by the content hash of the
+    volume, `step` and `overlap`. Everything is stored per block and only
+    on demand, so reopening a processed volume reads the metadata, then
+    the blocks which are asked for. A change of `range` or of the solver
+    only computes what is missing under the new parameters.
+        <root>/<key>/meta.json
+        <root>/<key>/blocks/<sn>.z                  voxels, zlib
+        <root>/<key>/<range>/counts.npy             in-range points, -1 unknown
+        <root>/<key>/<range>/coords/<sn>.z          coords local to the block
+        <root>/<key>/<range>/<solver>_<dtype>/<sn>.npy  `implicitFitting` vector
+    zlib at level 1 is the codec, it is in the standard library and
+    decompresses far faster than a block is fitted.
+    """
+    def __init__(self, path, bigMatrix=None, level=1):
+        """
+        Open a store, see `DivideImageLogic.getBlockStore` to create one
+        @param path         directory of the store
+        @param bigMatrix    the volume, to compute what is missing; without
+                            it only the stored chunks can be read
+        @param level        zlib compression level
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        self.path = path
+        self.bigMatrix = bigMatrix
+        self.level = level
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(str(meta['dtype']))
+        self.step = meta['step']
+        self.overlap = meta['overlap']
+        self.blockInfo = DivideImageLogic().getBlockInfo(self.shape, self.step, self.overlap)
+
+    @staticmethod
+    def create(root, contentHash, shape, dtype, step, overlap=[0] * 3):
+        """
+        Make the directory and metadata of a store if they do not exist
+        @return str         directory of the store
+        """
+        meta = {'contentHash': contentHash, 'shape': [int(n) for n in shape],
+                'dtype': np.dtype(dtype).str, 'step': [int(n) for n in step],
+                'overlap': [int(n) for n in overlap]}
+        key = hashlib.sha1(json.dumps(meta, sort_keys=True).encode('ascii')).hexdigest()
+        path = os.path.join(root, key[:16])
+
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            BlockStore._write(os.path.join(path, 'meta.json'),
+                              json.dumps(meta, sort_keys=True).encode('ascii'))
+
+        return path
+
+    @staticmethod
+    def _write(filePath, data):
+        """
+        Write a file atomically, a crash never leaves a truncated chunk
+        """
+        directory = os.path.dirname(filePath)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # made by another process meanwhile
+                if not os.path.isdir(directory):
+                    raise
+        temporaryPath = "%s.%d.tmp" % (filePath, os.getpid())
+        with open(temporaryPath, 'wb') as f:
+            f.write(data)
+        os.rename(temporaryPath, filePath)
+
+    def _getRangePath(self, range):
+        return os.path.join(self.path, "%g_%g" % tuple(range))
+
+    def _getMatrix(self):
+        if self.bigMatrix is None:
+            raise ValueError("The chunk is not stored and no volume is given to compute it")
+        return self.bigMatrix
+
+    def __len__(self):
+        return len(self.blockInfo.sns)
+
+    def getBlock(self, sn):
+        """
+        Voxels of a block, including the overlap
+        @return ndarray     3D array, a new copy
+        """
+        voi = self.blockInfo.vois[sn]
+        filePath = os.path.join(self.path, 'blocks', "%d.z" % sn)
+        if os.path.exists(filePath):
+            with open(filePath, 'rb') as f:
+                data = zlib.decompress(f.read())
+            return np.frombuffer(data, self.dtype).reshape(voi[1::2] - voi[::2]).copy()
+
+        block = np.ascontiguousarray(
+            self._getMatrix()[voi[0]:voi[1], voi[2]:voi[3], voi[4]:voi[5]])
+        self._write(filePath, zlib.compress(block.tobytes(), self.level))
+        return block
+
+    def getCoords(self, sn, range=[90, 100]):
+        """
+        In-range points of a block, see `DivideImageLogic.getCoords`
+        @return ndarray     a n*3 array, local to the block
+        """
+        filePath = os.path.join(self._getRangePath(range), 'coords', "%d.z" % sn)
+        if os.path.exists(filePath):
+            with open(filePath, 'rb') as f:
+                data = zlib.decompress(f.read())
+            return np.frombuffer(data, np.int16).reshape(-1, 3).astype(np.intp)
+
+        block = self.getBlock(sn)
+        coords = np.transpose(((block >= range[0]) & (block <= range[1])).nonzero())
+        self._write(filePath, zlib.compress(coords.astype(np.int16).tobytes(), self.level))
+        return coords
+
+    def getCounts(self, range=[90, 100]):
+        """
+        Number of in-range points of every block, computed once per range
+        @return ndarray     1D array by sn
+        """
+        filePath = os.path.join(self._getRangePath(range), 'counts.npy')
+        if os.path.exists(filePath):
+            counts = np.load(filePath)
+        else:
+            counts = -np.ones(len(self), dtype=np.int64)
+        isMissing = counts < 0
+        if not isMissing.any():
+            return counts
+
+        if isMissing.all() and not any(self.overlap) and self.bigMatrix is not None:
+            # One pass over the volume, the coords are left for later
+            counts = DivideImageLogic().getValidBlockGrid(
+                self.bigMatrix, self.step, range)[1].ravel()
+        else:
+            for sn in np.flatnonzero(isMissing):
+                counts[sn] = len(self.getCoords(sn, range))
+
+        stream = io.BytesIO()
+        np.save(stream, counts)
+        self._write(filePath, stream.getvalue())
+        return counts
+
+    def isValid(self, range=[90, 100], ratio=0.1):
+        """
+        Validity of every block by sn, the same standard as `getCoords`
+        @return ndarray     1D boolean array
+        """
+        vois = self.blockInfo.vois
+        sizes = np.prod(vois[:, 1::2] - vois[:, ::2], axis=1)
+        return self.getCounts(range) >= ratio * sizes
+
+    def _getFitPath(self, sn, range, solver, dtype):
+        return os.path.join(self._getRangePath(range),
+                            "%s_%s" % (solver, np.dtype(dtype).name), "%d.npy" % sn)
+
+    def getFit(self, sn, range=[90, 100], solver='solve', dtype=np.float64):
+        """
+        `implicitFitting` vector of a block, fitted once per parameters
+        """
+        filePath = self._getFitPath(sn, range, solver, dtype)
+        if os.path.exists(filePath):
+            return np.load(filePath)
+
+        vector = DivideImageLogic().implicitFitting(
+            self.getCoords(sn, range), dtype=dtype, solver=solver)
+        self._putFit(filePath, vector)
+        return vector
+
+    def _putFit(self, filePath, vector):
+        stream = io.BytesIO()
+        np.save(stream, vector)
+        self._write(filePath, stream.getvalue())
+
+    def fitValid(self, range=[90, 100], ratio=0.1, solver='solve', dtype=np.float64,
+                 processes=None):
+        """
+        Fit the valid blocks which are not fitted yet, see `DivideImageLogic.fitBlocks`
+        @return dict        sn --> vector of all valid blocks
+        """
+        logic = DivideImageLogic()
+        vectors = {}
+        missing = []
+        for sn in np.flatnonzero(self.isValid(range, ratio)):
+            filePath = self._getFitPath(sn, range, solver, dtype)
+            if os.path.exists(filePath):
+                vectors[sn] = np.load(filePath)
+            else:
+                missing.append(sn)
+
+        startTime = time.time()
+        blocks = ((sn, self.getCoords(sn, range)) for sn in missing)
+        for sn, vector in logic.fitBlocks(blocks, processes, dtype, solver):
+            self._putFit(self._getFitPath(sn, range, solver, dtype), vector)
+            vectors[sn] = vector
+        logging.debug("--- fitValid of %d new blocks, %d stored, uses %s seconds ---" %
+                      (len(missing), len(vectors) - len(missing), time.time() - startTime))
+
+        return vectors
+
+
+#
+# class: `MultiBlockVolume`
+#
+class MultiBlockVolume(object):
+    """
+    Volume rendering of many sub-images with a level of detail per block.
+    - Every block is a `vtkLODProp3D` over its pyramid, level 0 is the
+      block itself, level n is shrunk 2**n times by averaging
+    - `selectLevels` picks the level of every block by its size on the
+      screen: about one voxel per pixel, coarser when far away or small
+    - While the view is interacted with, every block is drawn one more level
+      coarser; the levels of the still view are set only after the view
+      has been still for `stillDelay` ms, so the full resolution textures
+      are not uploaded during the interaction
+    Usage:
+        ```
+        volumes = vtkLogic.addMultiBlockVolume(subImages, volumeProperty)
+        volumes.observe(vtkLogic.iren)
+        ```
+    """
+    def __init__(self, pyramids, volumeProperty, renderer, stillDelay=300):
+        """
+        @param pyramids         a pyramid of every block, see
+                                `DivideImageVTKLogic.getImagePyramid`
+        @param volumeProperty   `vtkVolumeProperty` shared by all blocks
+        @param renderer         `vtkRenderer` to choose the levels for
+        @param stillDelay       ms the view must stay still before the
+                                finer levels are loaded
+        """
+        self.renderer = renderer
+        self.numLevels = min(len(pyramid) for pyramid in pyramids)
+        self.stillDelay = stillDelay
+        self.props = []
+        self.lodIds = []
+        self.levels = np.zeros(len(pyramids), dtype=int)
+        self.isInteracting = False
+        self._observers = []
+        self._stillTimer = None
+
+        bounds, numVoxels = [], []
+        for pyramid in pyramids:
+            subImage = pyramid[0]
+            prop = vtk.vtkLODProp3D()
+            lodIds = []
+            for image in pyramid[:self.numLevels]:
+                mapper = vtk.vtkSmartVolumeMapper()
+                mapper.SetInputData(image)
+                lodIds.append(prop.AddLOD(mapper, volumeProperty, 0.0))
+            prop.AutomaticLODSelectionOff()
+            prop.SetSelectedLODID(lodIds[0])
+            self.props.append(prop)
+            self.lodIds.append(lodIds)
+            bounds.append(subImage.GetBounds())
+            numVoxels.append(max(subImage.GetDimensions()))
+
+        bounds = np.reshape(bounds, (-1, 3, 2))
+        self.centres = bounds.mean(axis=2)
+        self.radii = np.linalg.norm(bounds[:, :, 1] - bounds[:, :, 0], axis=1) / 2
+        self.numVoxels = np.asarray(numVoxels, dtype=float)
+
+        for prop in self.props:
+            renderer.AddVolume(prop)
+
+    def getScreenLevels(self):
+        """
+        Level of every block by the pixels its voxels take on the screen
+        @return ndarray     levels by block
+        """
+        camera = self.renderer.GetActiveCamera()
+        height = max(self.renderer.GetSize()[1], 1)
+
+        if camera.GetParallelProjection():
+            pixelsPerUnit = height / (2.0 * camera.GetParallelScale())
+            pixels = 2 * self.radii * pixelsPerUnit
+        else:
+            distances = np.linalg.norm(self.centres - camera.GetPosition(), axis=1)
+            distances = np.maximum(distances - self.radii, 1e-6)  # the nearest side
+            halfAngle = np.radians(camera.GetViewAngle()) / 2
+            pixels = self.radii / (distances * np.tan(halfAngle)) * height
+
+        pixelsPerVoxel = pixels / self.numVoxels
+        levels = np.floor(-np.log2(np.maximum(pixelsPerVoxel, 1e-6)))
+        return np.clip(levels, 0, self.numLevels - 1).astype(int)
+
+    def selectLevels(self, isInteracting=None):
+        """
+        Set the level of every block, see the class documentation
+        @param isInteracting    None for the current state of the view
+        @return ndarray         levels by block
+        """
+        if isInteracting is None:
+            isInteracting = self.isInteracting
+
+        levels = self.getScreenLevels()
+        if isInteracting:
+            levels = np.minimum(levels + 1, self.numLevels - 1)
+
+        for n in np.flatnonzero(levels != self.levels):
+            self.props[n].SetSelectedLODID(self.lodIds[n][levels[n]])
+        self.levels = levels
+
+        return levels
+
+    def _onStartInteraction(self, caller=None, event=None):
+        self.isInteracting = True
+        if self._stillTimer is not None:
+            self._stillTimer.stop()
+        self.selectLevels(True)
+
+    def _onEndInteraction(self, caller=None, event=None):
+        self.isInteracting = False
+        if self._stillTimer is None:
+            self._stillTimer = qt.QTimer()
+            self._stillTimer.setSingleShot(True)
+            self._stillTimer.connect('timeout()', self._onStill)
+        self._stillTimer.start(self.stillDelay)
+
+    def _onStill(self):
+        if self.isInteracting:
+            return
+        self.selectLevels(False)
+        renderWin = self.renderer.GetRenderWindow()
+        if renderWin is not None:
+            renderWin.Render()
+
+    def observe(self, interactor):
+        """
+        Follow the interaction of a view, by its interactor style if any
+        """
+        style = interactor.GetInteractorStyle() or interactor
+        self._observers.append((style, style.AddObserver(
+            'StartInteractionEvent', self._onStartInteraction)))
+        self._observers.append((style, style.AddObserver(
+            'EndInteractionEvent', self._onEndInteraction)))
+        self.selectLevels(False)
+
+    def remove(self):
+        """
+        Take the blocks out of the renderer and stop following the view
+        """
+        for caller, tag in self._observers:
+            caller.RemoveObserver(tag)
+        self._observers = []
+        if self._stillTimer is not None:
+            self._stillTimer.stop()
+        for prop in self.props:
+            self.renderer.RemoveVolume(prop)
+
+
+#
+# class: `LabelMapVolume`
+#
+class LabelMapVolume(object):
+    """
+    Volume rendering of a label map by a discrete colour table, e.g.
+    `colorfile.csv`. A label is not a grey value, so:
+    - the volume is sampled with nearest interpolation, never between labels
+    - the colour and opacity functions are constant over [label - 0.49,
+      label + 0.49]; they blend only in the 0.02 gap between two labels,
+      where no integer label value falls, so the GPU texture of the
+      functions never blends the colours of two labels
+    - every label can be shown, hidden or made translucent on its own,
+      only the opacity function is rebuilt
+    `lookupTable` is the dense indexed `vtkLookupTable` of the same colours,
+    for slices and polydata.
+    """
+    def __init__(self, imageData, labels, colors, opacity=1.0):
+        """
+        @param imageData    `vtkImageData` of label ids
+        @param labels       n label ids
+        @param colors       n*3 RGB in [0, 1]
+        @param opacity      opacity of every label but the background 0
+        """
+        self.labels = np.asarray(labels)
+        self.colors = np.asarray(colors, dtype=np.float64)
+        self.opacities = np.where(self.labels != 0, opacity, 0.0)
+
+        # Two nodes per label, at its bin edges
+        self._values = np.column_stack((self.labels - 0.49, self.labels + 0.49)).ravel()
+        self.colorFunc = vtk.vtkColorTransferFunction()
+        self.colorFunc.FillFromDataPointer(
+            len(self._values),
+            np.column_stack((self._values, np.repeat(self.colors, 2, axis=0))).ravel())
+        self.opacityFunc = vtk.vtkPiecewiseFunction()
+        self._updateOpacity()
+
+        volumeProperty = vtk.vtkVolumeProperty()
+        volumeProperty.SetColor(self.colorFunc)
+        volumeProperty.SetScalarOpacity(self.opacityFunc)
+        volumeProperty.SetInterpolationTypeToNearest()
+        volumeProperty.ShadeOff()
+        self.volumeProperty = volumeProperty
+
+        mapper = vtk.vtkSmartVolumeMapper()
+        mapper.SetInputData(imageData)
+        self.volume = vtk.vtkVolume()
+        self.volume.SetMapper(mapper)
+        self.volume.SetProperty(volumeProperty)
+
+        self.lookupTable = self.getLookupTable()
+
+    def getLookupTable(self):
+        """
+        Dense `vtkLookupTable` from the lowest label, or 0, to the highest,
+        entry `i` is label `i + first`; the labels missing from the colour
+        table are transparent
+        """
+        first = min(int(self.labels.min()), 0)  # negative labels are offset
+        numValues = int(self.labels.max()) - first + 1
+        table = np.zeros((numValues, 4), dtype=np.uint8)
+        table[self.labels - first, :3] = np.round(self.colors * 255)
+        table[self.labels - first, 3] = np.round(self.opacities * 255)
+
+        lookupTable = vtk.vtkLookupTable()
+        lookupTable.SetNumberOfTableValues(numValues)
+        lookupTable.SetTable(numpy_support.numpy_to_vtk(table, deep=True))
+        # value `i` --> entry `i - first`
+        lookupTable.SetTableRange(first - 0.5, first + numValues - 0.5)
+        return lookupTable
+
+    def _updateOpacity(self):
+        nodes = np.column_stack((self._values, np.repeat(self.opacities, 2)))
+        self.opacityFunc.FillFromDataPointer(len(self._values), nodes.ravel())
+
+    def setOpacity(self, labels, opacity):
+        """
+        @param labels       a label id or a list of them
+        @param opacity      in [0, 1], 0 hides the labels
+        """
+        self.opacities[np.in1d(self.labels, labels)] = opacity
+        self._updateOpacity()
+        self.lookupTable = self.getLookupTable()
+
+    def setVisible(self, labels, isVisible=True, opacity=1.0):
+        """
+        Show or hide labels, shown at `opacity`
+        """
+        self.setOpacity(labels, opacity if isVisible else 0.0)
+
+
 #
 # Module
 #
@@ -507,6 +1908,8 @@ class DivideImageWidget(ScriptedLoadableModuleWidget):
         self.cleanSceneBtn.connect('clicked(bool)', self.onCleanSceneBtn)
         self.testBtn.connect('clicked(bool)', self.onTestBtn)
         self.testBtn2.connect('clicked(bool)', self.onTestBtn2)
+        self.divideStepWidget.connect('coordinatesChanged(double*)',
+                                      self.onDivideStepChanged)
 
     def onReload(self):
         ScriptedLoadableModuleWidget.onReload(self)
@@ -575,6 +1978,8 @@ class DivideImageWidget(ScriptedLoadableModuleWidget):
     # Response functions
     #
     def onVolumeSelectChanged(self):
+        # Only the integral volumes of the selected volume are of use
+        DivideImageLogic().clearIntegralVolumes()
         if self.volumeSelector1.currentNode()is None:
             self.testBtn.enabled = False
             self.testBtn2.enabled = False
@@ -584,8 +1989,24 @@ class DivideImageWidget(ScriptedLoadableModuleWidget):
             self.testBtn2.enabled = True
             self.cleanSceneBtn.enabled = True
 
+    def onDivideStepChanged(self):
+        """
+        Count the valid subMatrices of the new step from the integral volume,
+        the volume is only scanned for the first step
+        """
+        volumeNode = self.volumeSelector1.currentNode()
+        divideStep = self.getDivideStep()
+        if volumeNode is None or not divideStep or min(divideStep) <= 0:
+            return
+
+        logic = DivideImageLogic()
+        isValidGrid = logic.getIntegralVolume(volumeNode).isValidGrid(divideStep)
+        self.testBtn.setText(str(np.sum(isValidGrid)) + '/' +
+                             str(isValidGrid.size) + "\nValid Sub Matrices")
+
     def onCleanSceneBtn(self):
         slicer.mrmlScene.Clear(0)
+        DivideImageLogic().clearIntegralVolumes()
         self.cleanSceneBtn.enabled = False
         self.testBtn.enabled = False
         self.testBtn2.enabled = False
@@ -608,8 +2029,11 @@ class DivideImageWidget(ScriptedLoadableModuleWidget):
         self.volumeLabel.setText("Volume " + str(ndarryShape) + ':')
         logging.debug("The shape of the ndarray: " + str(ndarryShape))
 
-        # Get subMatrices with given step
+        # Get subMatrices with given step, the counts of
+        # `onDivideStepChanged` are not needed
+        wasBlocked = self.divideStepWidget.blockSignals(True)
         self.setDivideStep(step=[20] * 3)
+        self.divideStepWidget.blockSignals(wasBlocked)
         divideStep = self.getDivideStep()
         # subMatrices = logic.getSubMatrices(volumeNode, divideStep)
 
@@ -684,7 +2108,9 @@ class DivideImageWidget(ScriptedLoadableModuleWidget):
 
         #
         # Get subMatrices with given step
+        wasBlocked = self.divideStepWidget.blockSignals(True)
         self.setDivideStep([20] * 3)
+        self.divideStepWidget.blockSignals(wasBlocked)
         divideStep = self.getDivideStep()
         # divideStep = [20] * 3
         # subMatrices = logic.getSubMatrices(volumeNode, divideStep)
@@ -710,6 +2136,10 @@ class DivideImageWidget(ScriptedLoadableModuleWidget):
 #
 class DivideImageVTKLogic(ScriptedLoadableModuleLogic):
 
+    # Shared by all instances: parsed colour tables and built transfer functions
+    _colorTables = {}
+    _transferFuncs = {}
+
     def __init__(self, isInsideRenWin=True):
         # ScriptedLoadableModuleLogic.__init__(self, parent)
         iren = vtk.vtkRenderWindowInteractor()
@@ -800,24 +2230,92 @@ class DivideImageVTKLogic(ScriptedLoadableModuleLogic):
 
         self.renderer.AddActor(actor)
 
-    def addPoints(self, coords, color=colors.chartreuse, radius=0.3):
+    def getPointCloud(self, coords, scalars=None):
+        """
+        Wrap a coords array in a `vtkPolyData` without copying, when it is
+        already a C-contiguous float array
+        @param coords       n*3 array
+        @param scalars      None, n scalars or n*3 uint8 RGB colours
+        @return vtkPolyData     only points, no cells, for the point mappers
+        """
+        coords = np.asarray(coords)
+        if coords.dtype not in (np.float32, np.float64):
+            coords = coords.astype(np.float32)
+        coords = np.ascontiguousarray(coords)
+
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(coords, deep=False))
+        polyData = vtk.vtkPolyData()
+        polyData.SetPoints(points)
+
+        if scalars is not None:
+            scalars = np.ascontiguousarray(scalars)
+            vtkScalars = numpy_support.numpy_to_vtk(scalars, deep=False)
+            vtkScalars.SetName('scalars')
+            polyData.GetPointData().SetScalars(vtkScalars)
+
+        polyData._numpy_reference = (coords, scalars)  # keep the buffers alive
+
+        return polyData
+
+    def addPoints(self, coords, color=colors.chartreuse, radius=0.3, scalars=None,
+                  scalarRange=None, mode='glyph'):
         """
-        Add a set of points to vtkRenderer with a given coords array
+        Add a set of points to vtkRenderer with a given coords array, all of
+        them in one `vtkPolyData` behind one actor, drawn by the GPU
+        - 'glyph': a sphere instanced at every point by `vtkGlyph3DMapper`
+        - 'sprite': a splat per point by `vtkPointGaussianMapper`, the
+          cheapest for 100k points and more
+        @param coords       n*3 array
+        @param color        colour of the points without `scalars`
+        @param scalars      n scalars, coloured by a lookup table over
+                            `scalarRange`, or n*3 uint8 RGB colours
+        @param scalarRange  (min, max), the range of `scalars` by default
+        @param mode         'glyph' or 'sprite'
+        @return vtkActor
         """
-        numPoints = len(coords)
         startTime = time.time()
-        for i in range(numPoints):
-            self.addPoint(coords[i, :], color, radius)
-        logging.debug(str(numPoints) + " points rendering takes time: " + str(time.time() - startTime))
+        polyData = self.getPointCloud(coords, scalars)
+
+        if mode == 'glyph':
+            sphere = vtk.vtkSphereSource()
+            sphere.SetRadius(radius)
+            sphere.SetPhiResolution(8)
+            sphere.SetThetaResolution(8)
+
+            mapper = vtk.vtkGlyph3DMapper()
+            mapper.SetSourceConnection(sphere.GetOutputPort())
+            mapper.ScalingOff()
+            mapper.OrientOff()
+        elif mode == 'sprite':
+            mapper = vtk.vtkPointGaussianMapper()
+            mapper.SetScaleFactor(radius)
+            mapper.EmissiveOff()
+        else:
+            raise ValueError("Unknown mode: %s" % mode)
+        mapper.SetInputData(polyData)
 
-        # NOTE: the following is correct, but slower.
-        # threadNum = 4
-        # startTime = time.time()
-        # pool = ThreadPool(threadNum)
-        # pool.map(self.addPoint, coords)
-        # pool.close()
-        # pool.join()
-        # logging.info("Time taken: {}".format(time.time() - startTime))
+        if scalars is None:
+            mapper.ScalarVisibilityOff()
+        else:
+            mapper.ScalarVisibilityOn()
+            mapper.SetScalarModeToUsePointData()
+            if np.ndim(scalars) == 2:  # RGB colours
+                mapper.SetColorModeToDirectScalars()
+            else:
+                if scalarRange is None:
+                    scalarRange = (np.min(scalars), np.max(scalars))
+                mapper.SetScalarRange(scalarRange)
+
+        actor = vtk.vtkActor()
+        actor.SetMapper(mapper)
+        actor.GetProperty().SetColor(color)
+        self.addActor(actor)
+
+        logging.debug(str(len(polyData._numpy_reference[0])) +
+                      " points rendering takes time: " + str(time.time() - startTime))
+
+        return actor
 
     def addText(self, position=[0, 0, 0], texts="Origin",
                 color=colors.olive, scale=5):
@@ -976,96 +2474,204 @@ class DivideImageVTKLogic(ScriptedLoadableModuleLogic):
 
         iren.Start()
 
-    def getTransferFuncFromFile(self, color_file, opacity=0.25):
+    def readColorTable(self, color_file):
         """
-        Return transfer function from file for volume rendering
+        Parse a colour table once per file version, label by label
+        Lines: `label,name,R,G,B`, colours in [0, 255]
         @param      a `cvs` file containing colours
-        @return1    func_color_transfor
-        @return2    func_opacity_scalar
-        @retrun3    func_opacity_gradient
+        @return     objdict of `labels` (n), `names` (n) and `colors` (n*3 in
+                    [0, 1]), sorted by label, the last line of a label wins
         """
+        color_file = os.path.abspath(color_file)
+        key = ('table', color_file, os.path.getmtime(color_file))
+        cache = DivideImageVTKLogic._colorTables
+        if key in cache:
+            return cache[key]
 
         import csv
-        fid = open(color_file, "r")
-        reader_color = csv.reader(fid)
+        with open(color_file, "r") as fid:
+            rows = [line for line in csv.reader(fid) if line]
 
-        dict_RGB = {}
-        for line in reader_color:
-            dict_RGB[int(line[0])] = [float(line[2]) / 255.0,
-                                      float(line[3]) / 255.0,
-                                      float(line[4]) / 255.0]
-        fid.close()
+        labels = np.array([int(line[0]) for line in rows])
+        colors = np.array([[float(c) for c in line[2:5]] for line in rows]) / 255.0
+        names = [line[1] for line in rows]
 
-        # Define colour transfer function
-        func_color_transfor = vtk.vtkColorTransferFunction()
+        # Sorted unique labels, the last occurrence of each
+        reverseOrder = np.arange(len(labels))[::-1]
+        _, last = np.unique(labels[::-1], return_index=True)
+        order = reverseOrder[last]
 
-        for idx in dict_RGB.keys():
-            func_color_transfor.AddRGBPoint(idx,
-                                            dict_RGB[idx][0],
-                                            dict_RGB[idx][1],
-                                            dict_RGB[idx][2])
+        table = objdict(labels=labels[order], names=[names[i] for i in order],
+                        colors=colors[order])
+        cache[key] = table
+        return table
 
-        # Opacity transfer function
-        func_opacity_scalar = vtk.vtkPiecewiseFunction()
-
-        for idx in dict_RGB.keys():
-            func_opacity_scalar.AddPoint(idx, opacity if idx != 0 else 0.0)
+    def buildColorTransferFunc(self, values, colors):
+        """
+        Build a `vtkColorTransferFunction` from arrays at once
+        @param values       n nodes
+        @param colors       n*3 RGB in [0, 1]
+        """
+        nodes = np.column_stack((values, colors)).astype(np.float64).ravel()
+        func = vtk.vtkColorTransferFunction()
+        func.FillFromDataPointer(len(values), nodes)
+        return func
 
-        # Opacity Gradient Transfer function
-        func_opacity_gradient = vtk.vtkPiecewiseFunction()
-        func_opacity_gradient.AddPoint(1, 0.0)
-        func_opacity_gradient.AddPoint(5, 0.1)
-        func_opacity_gradient.AddPoint(100, 1.0)
+    def buildPiecewiseFunc(self, values, opacities):
+        """
+        Build a `vtkPiecewiseFunction` from arrays at once
+        @param values       n nodes
+        @param opacities    n values
+        """
+        nodes = np.column_stack((values, opacities)).astype(np.float64).ravel()
+        func = vtk.vtkPiecewiseFunction()
+        func.FillFromDataPointer(len(values), nodes)
+        return func
 
-        return func_color_transfor, func_opacity_scalar, func_opacity_gradient
+    def getTransferFuncFromFile(self, color_file, opacity=0.25):
+        """
+        Return transfer function from file for volume rendering
+        The functions are built once per file version and `opacity`, then
+        shared by all callers: modify a copy (`DeepCopy`), not them.
+        @param      a `cvs` file containing colours
+        @return1    func_color_transfor
+        @return2    func_opacity_scalar
+        @retrun3    func_opacity_gradient
+        """
+        table = self.readColorTable(color_file)
+        key = ('file', os.path.abspath(color_file),
+               os.path.getmtime(color_file), opacity)
+        cache = DivideImageVTKLogic._transferFuncs
+        if key in cache:
+            return cache[key]
+
+        labels = table.labels
+        func_color_transfor = self.buildColorTransferFunc(labels, table.colors)
+        func_opacity_scalar = self.buildPiecewiseFunc(
+            labels, np.where(labels != 0, opacity, 0.0))
+        func_opacity_gradient = self.buildPiecewiseFunc([1, 5, 100], [0.0, 0.1, 1.0])
+
+        cache[key] = (func_color_transfor, func_opacity_scalar, func_opacity_gradient)
+        return cache[key]
 
     def getPredefinedTransferFunc(self, pre_num=0):
 
         """
-        Predefined transfer functions
+        Predefined transfer functions, built once and shared by all callers
         pre_num:
         0: bones
+        1: CTK skull
         """
+        key = ('predefined', pre_num)
+        cache = DivideImageVTKLogic._transferFuncs
+        if key in cache:
+            return cache[key]
 
-        # Define colour transfer function
-        func_color_transfor = vtk.vtkColorTransferFunction()
-        func_opacity_scalar = vtk.vtkPiecewiseFunction()
-        func_opacity_gradient = vtk.vtkPiecewiseFunction()
-
+        # (values, colours), (values, opacities) and (values, gradient opacities)
         if pre_num == 0:  # bones
-            func_color_transfor.AddRGBPoint(-500, 247.0 / 255, 150.0 / 255, 155.0 / 255)
-            func_color_transfor.AddRGBPoint(0, 247.0 / 255, 150.0 / 255, 155.0 / 255)
-            func_color_transfor.AddRGBPoint(500, 255.0 / 255, 255.0 / 255, 230.0 / 255)
+            color = ([-500, 0, 500], np.array([[247, 150, 155],
+                                               [247, 150, 155],
+                                               [255, 255, 230]]) / 255.0)
+            scalar = ([-500, 0, 500], [0.15, 0.15, 0.9])
+            gradient = ([0, 90, 100], [0.0, 0.5, 1.0])
+        elif pre_num == 1:  # For the CTK skull
+            color = ([0.0, 600.0, 1280.0, 1960.0, 4095.0], [[0.5, 0.0, 0.0],
+                                                            [1.0, 0.5, 0.5],
+                                                            [0.9, 0.2, 0.3],
+                                                            [0.81, 0.27, 0.1],
+                                                            [0.5, 0.5, 0.5]])
+            scalar = ([70.0, 599.0, 600.0, 1195.0, 1200, 1300, 2000, 4095.0],
+                      [0.0, 0, 0, 0, .2, .3, .3, 1.0])
+            gradient = ([0, 90, 100], [0.0, 0.5, 1.0])
+        else:
+            color = (np.zeros(0), np.zeros((0, 3)))
+            scalar = gradient = (np.zeros(0), np.zeros(0))
 
-            func_opacity_scalar.AddPoint(-500, 0.15)
-            func_opacity_scalar.AddPoint(0, 0.15)
-            func_opacity_scalar.AddPoint(500, 0.9)
+        cache[key] = (self.buildColorTransferFunc(*color),
+                      self.buildPiecewiseFunc(*scalar),
+                      self.buildPiecewiseFunc(*gradient))
+        return cache[key]
 
-            func_opacity_gradient.AddPoint(0, 0.0)
-            func_opacity_gradient.AddPoint(90, 0.5)
-            func_opacity_gradient.AddPoint(100, 1.0)
+    def addLabelMapVolume(self, node, color_file, opacity=1.0):
+        """
+        Volume render a segmentation by its discrete colour table, see
+        `LabelMapVolume`. Usage:
+            ```
+            labelMapVolume = vtkLogic.addLabelMapVolume(labelMapNode, colorFile)
+            labelMapVolume.setVisible([2, 3], False)  # hide the ventricles
+            ```
+        @param node         `vtkMRMLLabelMapVolumeNode`, `vtkImageData` or ndarray
+        @param color_file   a `cvs` file of label colours, see `readColorTable`
+        @param opacity      opacity of every label but the background 0
+        @return LabelMapVolume
+        """
+        if isinstance(node, np.ndarray):
+            imageData = DivideImageLogic().vtkImageDataFromNdarray(node)
+        elif node.IsA('vtkImageData'):
+            imageData = node
+        else:  # a volume node
+            imageData = node.GetImageData()
 
-        elif pre_num == 1:  # For the CTK skull
-            func_color_transfor.AddRGBPoint(0.0, 0.5, 0.0, 0.0)
-            func_color_transfor.AddRGBPoint(600.0, 1.0, 0.5, 0.5)
-            func_color_transfor.AddRGBPoint(1280.0, 0.9, 0.2, 0.3)
-            func_color_transfor.AddRGBPoint(1960.0, 0.81, 0.27, 0.1)
-            func_color_transfor.AddRGBPoint(4095.0, 0.5, 0.5, 0.5)
-
-            func_opacity_scalar.AddPoint(70.0, 0.0)
-            func_opacity_scalar.AddPoint(599.0, 0)
-            func_opacity_scalar.AddPoint(600.0, 0)
-            func_opacity_scalar.AddPoint(1195.0, 0)
-            func_opacity_scalar.AddPoint(1200, .2)
-            func_opacity_scalar.AddPoint(1300, .3)
-            func_opacity_scalar.AddPoint(2000, .3)
-            func_opacity_scalar.AddPoint(4095.0, 1.0)
-
-            func_opacity_gradient.AddPoint(0, 0.0)
-            func_opacity_gradient.AddPoint(90, 0.5)
-            func_opacity_gradient.AddPoint(100, 1.0)
-
-        return func_color_transfor, func_opacity_scalar, func_opacity_gradient
+        table = self.readColorTable(color_file)
+        labelMapVolume = LabelMapVolume(imageData, table.labels, table.colors, opacity)
+        self.renderer.AddVolume(labelMapVolume.volume)
+
+        return labelMapVolume
+
+    def addPolyData(self, polyData, color=colors.light_salmon):
+        """
+        Add a polydata with normals, e.g. of `DivideImageLogic.contourBlocks`,
+        as one actor
+        @return     vtkActor
+        """
+        mapper = vtk.vtkPolyDataMapper()
+        mapper.SetInputData(polyData)
+        mapper.SetScalarVisibility(False)
+
+        actor = vtk.vtkActor()
+        actor.SetMapper(mapper)
+        actor.GetProperty().SetDiffuseColor(color)
+        actor.GetProperty().SetSpecular(0.3)
+        actor.GetProperty().SetSpecularPower(20)
+        actor.GetProperty().SetInterpolation(2)
+        self.addActor(actor)
+
+        return actor
+
+    def getImagePyramid(self, imageData, numLevels=3):
+        """
+        Multiresolution pyramid of an image, every level is shrunk 2 times
+        from the previous one by averaging. A coarse level covers the same
+        region less the last voxel of an odd dimension.
+        @return list        `vtkImageData`, level 0 is `imageData` itself
+        """
+        pyramid = [imageData]
+        for _ in np.arange(1, numLevels):
+            if min(pyramid[-1].GetDimensions()) < 2:
+                pyramid.append(pyramid[-1])  # nothing left to shrink
+                continue
+            shrink = vtk.vtkImageShrink3D()
+            shrink.SetInputData(pyramid[-1])
+            shrink.SetShrinkFactors(2, 2, 2)
+            shrink.AveragingOn()
+            shrink.Update()
+            pyramid.append(shrink.GetOutput())
+
+        return pyramid
+
+    def addMultiBlockVolume(self, subImages, volumeProperty, numLevels=3):
+        """
+        Volume render many sub-images with a level of detail per block,
+        see `MultiBlockVolume`
+        @return MultiBlockVolume    its `observe` follows the interaction
+        """
+        startTime = time.time()
+        pyramids = [self.getImagePyramid(subImage, numLevels) for subImage in subImages]
+        volumes = MultiBlockVolume(pyramids, volumeProperty, self.renderer)
+        logging.debug("--- addMultiBlockVolume of %d blocks uses %s seconds ---" %
+                      (len(subImages), time.time() - startTime))
+
+        return volumes
 
     def getVolumeActor(self, vtk_source, volume_prop):
         """
@@ -1089,6 +2695,15 @@ class DivideImageVTKLogic(ScriptedLoadableModuleLogic):
 #
 class DivideImageLogic(ScriptedLoadableModuleLogic):
 
+    # Shared by all instances, the widget creates a new logic on every click
+    _integralVolumes = collections.OrderedDict()
+    _numIntegralVolumes = 2
+    _contentHashes = collections.OrderedDict()
+    _numContentHashes = 8
+    # Results of `implicitFitting` and `radialBasisFunc` by their arguments,
+    # None to turn it off, `ResultCache(maxBytes, path)` for a disk tier
+    resultCache = ResultCache()
+
     def hasImageData(self, volumeNode):
 
         if not volumeNode:
@@ -1115,17 +2730,113 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
             self.step = step
             return True
 
+    def readNrrdHeader(self, filePath):
+        """
+        Parse the header of a NRRD volume, either attached (`.nrrd`) or
+        detached (`.nhdr` + data file), enough to memory-map a raw payload
+        @param filePath     path of the `.nrrd` or `.nhdr` file
+        @return objdict
+            shape       NumPy shape, the reversed `sizes`
+            dtype       NumPy dtype with the byte order
+            encoding    'raw', 'gzip', ...
+            dataFile    path of the payload
+            offset      byte offset of the payload in `dataFile`
+            spacing     voxel size along the `sizes` axes (x, y, z)
+            origin      `space origin`, zeros if absent
+        """
+        fields = {}
+        with open(filePath, 'rb') as f:
+            magic = f.readline()
+            if not magic.startswith(b'NRRD'):
+                raise ValueError("%s is not a NRRD file" % filePath)
+            while True:
+                line = f.readline()
+                if not line.strip():  # blank line or end of a detached header
+                    break
+                line = line.decode('ascii', 'replace').strip()
+                if line.startswith('#') or ':' not in line:
+                    continue
+                key, value = line.split(':', 1)
+                fields[key.strip().lower()] = value.lstrip('=').strip()
+            headerSize = f.tell()
+
+        try:
+            shape = tuple(int(n) for n in reversed(fields['sizes'].split()))
+            dtype = np.dtype(_NRRD_TYPES[fields['type'].lower()])
+        except KeyError as e:
+            raise ValueError("Unsupported NRRD header of %s: %s" % (filePath, e))
+        if dtype.itemsize > 1:
+            dtype = dtype.newbyteorder('>' if fields.get('endian') == 'big' else '<')
+
+        if 'data file' in fields or 'datafile' in fields:
+            dataFile = fields.get('data file', fields.get('datafile'))
+            if dataFile.split()[0] == 'LIST' or '%' in dataFile:
+                raise ValueError("Multiple data files are not supported: %s" % dataFile)
+            dataFile = os.path.join(os.path.dirname(os.path.abspath(filePath)), dataFile)
+            offset = 0
+        else:
+            dataFile = filePath
+            offset = headerSize
+
+        lineSkip = int(fields.get('line skip', fields.get('lineskip', 0)))
+        if lineSkip:
+            with open(dataFile, 'rb') as f:
+                f.seek(offset)
+                for _ in range(lineSkip):
+                    f.readline()
+                offset = f.tell()
+        byteSkip = int(fields.get('byte skip', fields.get('byteskip', 0)))
+        if byteSkip == -1:  # the payload is at the end of the file
+            offset = os.path.getsize(dataFile) - int(np.prod(shape)) * dtype.itemsize
+        else:
+            offset += byteSkip
+
+        if 'space directions' in fields:
+            directions = [d.strip('() ') for d in fields['space directions'].split(')')]
+            spacing = [np.linalg.norm([float(v) for v in d.split(',')])
+                       for d in directions if d and d != 'none']
+        else:
+            spacing = [float(v) for v in fields.get('spacings', '1 1 1').split()]
+        if 'space origin' in fields:
+            origin = [float(v) for v in fields['space origin'].strip('() ').split(',')]
+        else:
+            origin = [0.0] * 3
+
+        return objdict(shape=shape, dtype=dtype, encoding=fields.get('encoding', 'raw'),
+                       dataFile=dataFile, offset=offset, spacing=spacing, origin=origin)
+
+    def openVolume(self, filePath, mode='r'):
+        """
+        Open a raw NRRD volume as `numpy.memmap`, nothing is read until a
+        block is touched, then the OS page cache does the I/O. The blocks
+        of `getValidSubMatrices`, `iterSubMatrices` etc. are memory-mapped too,
+        and the whole-volume scans (`getValidBlockGrid`, `getBlockHistogram`,
+        `getCoordsStore`) go slab by slab, so the memory in use is bounded by
+        the working set of blocks rather than the volume size.
+        @param filePath     `.nrrd` or `.nhdr` file, the encoding must be 'raw'
+        @param mode         'r' read-only, 'r+' to write back, 'c' copy-on-write
+        @return numpy.memmap    in the order of the big matrix, [z, y, x]
+        """
+        header = self.readNrrdHeader(filePath)
+        if header.encoding != 'raw':
+            raise ValueError("A %s encoded volume cannot be memory-mapped, "
+                             "save it with raw encoding first: %s" %
+                             (header.encoding, filePath))
+
+        return np.memmap(header.dataFile, dtype=header.dtype, mode=mode,
+                         offset=header.offset, shape=header.shape)
+
     def getNdarray(self, node):
 
         if isinstance(node, np.ndarray):
             ndarray = node
+        elif isinstance(node, _stringTypes):  # a raw NRRD file
+            ndarray = self.openVolume(node)
         elif node.GetClassName() in ('vtkMRMLScalarVolumeNode',
                                      'vtkMRMLLabelMapVolumeNode'):  # scalarTypes
             ndarray = slicer.util.array(node.GetID())
         elif node.GetClassName() == 'vtkImageData':  # not `is`
-            shape = list(node.GetDimensions())
-            shape.reverse()
-            ndarray = vtk.util.numpy_support.vtk_to_numpy(node.GetPointData().GetScalars()).reshape(shape)
+            ndarray = self.ndarrayFromVtkImageData(node)
         else:
             raise TypeError("The node cannot be converted to NumPy array!")
 
@@ -1221,29 +2932,651 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
         posterior = (i, j, None if k == kx else k + 1)
         neighbours = (superior, inferior, left, right, anterior, posterior)
 
-        subImage.index = i, j, k
-        subImage.neighbours = neighbours
-        subImage.sn = extentIndexSn[-1]
+        subImage.index = i, j, k
+        subImage.neighbours = neighbours
+        subImage.sn = extentIndexSn[-1]
+
+        return subImage  # still `vtkImageData`, but attached `index`, `neighbours` and `sn`
+
+    def getBlockInfo(self, shape, step=[40] * 3, overlap=[0] * 3, order='raster'):
+        """
+        `voi`, `extent`, `index`, `sn` and 6-neighbours of all blocks as
+        parallel arrays, the same division and raster order as `_getSubImageInfo`
+        @param shape        shape of the big matrix
+        @param order        'raster', or number the blocks along a 'morton' or
+                            'hilbert' curve, see `BlockLayout`
+        @return objdict
+            grid        (nz, ny, nx), number of blocks along every axis
+            vois        N*6, (i0, i1, j0, j1, k0, k1) in the big matrix
+            extents     N*6, (k0, k1 - 1, j0, j1 - 1, i0, i1 - 1)
+            indices     N*3, (i, j, k)
+            sns         N
+            neighbours  N*6, sn of the superior, inferior, left, right,
+                        anterior and posterior neighbour, -1 if none
+        """
+        if overlap[0] >= step[0] / 2 or overlap[1] >= step[1] / 2 or overlap[2] >= step[2] / 2:
+            raise AttributeError("Overlap is too large!")
+
+        starts = [np.arange(0, n, s) for n, s in zip(shape, step)]
+        stops = [np.minimum(b + s + o, n) for b, s, o, n in zip(starts, step, overlap, shape)]
+        grid = tuple(len(b) for b in starts)
+
+        indices = np.indices(grid).reshape(3, -1).T
+        i, j, k = indices.T
+        vois = np.column_stack((starts[0][i], stops[0][i], starts[1][j], stops[1][j],
+                                starts[2][k], stops[2][k]))
+        extents = vois[:, [4, 5, 2, 3, 0, 1]] - [0, 1, 0, 1, 0, 1]
+
+        sns = np.arange(len(indices))
+        padded = np.pad(sns.reshape(grid), 1, mode='constant', constant_values=-1)
+        i, j, k = i + 1, j + 1, k + 1
+        neighbours = np.column_stack((padded[i - 1, j, k], padded[i + 1, j, k],
+                                      padded[i, j - 1, k], padded[i, j + 1, k],
+                                      padded[i, j, k - 1], padded[i, j, k + 1]))
+
+        if order != 'raster':
+            layout = BlockLayout(grid, order)
+            vois, extents, indices = (a[layout.rasterOf] for a in (vois, extents, indices))
+            neighbours = layout.toCurve(neighbours[layout.rasterOf])
+
+        return objdict(grid=grid, vois=vois, extents=extents, indices=indices,
+                       sns=sns, neighbours=neighbours)
+
+    def getBlockRegistry(self, node, step=[40] * 3, overlap=[0] * 3, range=[90, 100],
+                         ratio=0.1, order='raster'):
+        """
+        Divide a volume into a `BlockRegistry`, the blocks are counted at once
+        without slicing the big matrix block by block
+        Usage:
+            ```
+            registry = logic.getBlockRegistry(volumeNode, step)
+            borderSns = registry.getBorderBlocks()
+            ```
+        @param node         volume node, `vtkImageData`, ndarray or file path
+        @param range        a grey value range
+        @param ratio        least ratio of in-range points of a valid block
+        @param order        numbering of the blocks, see `getBlockInfo`
+        @return BlockRegistry
+        """
+        bigMatrix = self.getNdarray(node)
+        blockInfo = self.getBlockInfo(bigMatrix.shape, step, overlap, order)
+
+        if any(overlap):
+            counts, _ = self.getIntegralVolume(node, range).blockCounts(step, overlap)
+        else:
+            _, counts = self.getValidBlockGrid(bigMatrix, step, range)
+        rasterSns = np.ravel_multi_index(blockInfo.indices.T, blockInfo.grid)
+
+        return BlockRegistry(blockInfo, counts.ravel()[rasterSns], ratio)
+
+    def getBlockKeys(self, indices, order='morton'):
+        """
+        Position of blocks along a space-filling curve, blocks near on the
+        curve are near in space. It keeps the working set of a streaming
+        pass local, e.g. the neighbours of a block are read shortly after it.
+        @param indices      N*3 integer array of block indices (i, j, k)
+        @param order        'morton' (Z-order) or 'hilbert'
+        @return ndarray     N keys, sort the blocks by them
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        numBits = max(int(indices.max()).bit_length(), 1) if len(indices) else 1
+        x = [indices[:, 0].copy(), indices[:, 1].copy(), indices[:, 2].copy()]
+
+        if order == 'hilbert':
+            # Skilling, "Programming the Hilbert curve", 2004: axes to transpose
+            q = 1 << (numBits - 1)
+            while q > 1:
+                p = q - 1
+                for n in (0, 1, 2):
+                    isSet = (x[n] & q) != 0
+                    x[0] = np.where(isSet, x[0] ^ p, x[0])  # invert
+                    t = np.where(isSet, 0, (x[0] ^ x[n]) & p)  # exchange
+                    x[0] ^= t
+                    x[n] ^= t
+                q >>= 1
+            # Gray encode
+            x[1] ^= x[0]
+            x[2] ^= x[1]
+            t = np.zeros_like(x[0])
+            q = 1 << (numBits - 1)
+            while q > 1:
+                t = np.where(x[2] & q, t ^ (q - 1), t)
+                q >>= 1
+            for n in (0, 1, 2):
+                x[n] ^= t
+        elif order != 'morton':
+            raise ValueError("Unknown order: %s" % order)
+
+        # Interleave the bits a byte at a time, axis 0 is the most significant
+        keys = np.zeros(len(indices), dtype=np.int64)
+        for b in np.arange(0, numBits, 8):
+            keys |= ((_MORTON_SPREAD[(x[0] >> b) & 0xff] << 2) |
+                     (_MORTON_SPREAD[(x[1] >> b) & 0xff] << 1) |
+                     _MORTON_SPREAD[(x[2] >> b) & 0xff]) << (3 * b)
+
+        return keys
+
+    def getBlockOrder(self, grid, order='raster'):
+        """
+        sn of all blocks of a grid in a traversal order
+        @param grid         (nz, ny, nx), number of blocks along every axis
+        @param order        'raster', the sn order, 'morton' or 'hilbert'
+        @return ndarray     a permutation of the sn
+        """
+        numBlocks = int(np.prod(grid))
+        if order == 'raster':
+            return np.arange(numBlocks)
+
+        indices = np.indices(grid).reshape(3, -1).T
+        return np.argsort(self.getBlockKeys(indices, order), kind='mergesort')
+
+    def getBlockArray(self, node, step=[40] * 3, order='morton', fill=0):
+        """
+        Copy all blocks into one contiguous array, block after block in the
+        order of a `BlockLayout`, so a sweep over blocks and their neighbours
+        touches nearby memory. The ragged edge blocks are padded with `fill`.
+        The volume is read slab by slab, it may be memory-mapped.
+        Usage:
+            ```
+            blocks, layout = logic.getBlockArray(volumeNode, step, 'hilbert')
+            block = blocks[layout.encode((i, j, k))]
+            ```
+        @param node         volume node, `vtkImageData`, ndarray or file path
+        @param step         shape of subMatrix, without overlap
+        @return 1           (N, step[0], step[1], step[2]) array, by curve sn
+        @return 2           `BlockLayout` of the grid
+        """
+        bigMatrix = self.getNdarray(node)
+        shape = bigMatrix.shape
+        step = [int(s) for s in step]
+        grid = [-(-n // s) for n, s in zip(shape, step)]  # ceil division
+        layout = BlockLayout(grid, order)
+        numRowBlocks = grid[1] * grid[2]
+
+        blocks = np.empty([len(layout)] + step, dtype=bigMatrix.dtype)
+        slab = np.empty([step[0], grid[1] * step[1], grid[2] * step[2]], dtype=bigMatrix.dtype)
+        for n, i in enumerate(np.arange(0, shape[0], step[0])):
+            slab.fill(fill)
+            source = bigMatrix[i:i + step[0]]
+            slab[:len(source), :shape[1], :shape[2]] = source
+            rowBlocks = self.getBlockView(slab, step)[0].reshape([numRowBlocks] + step)
+            blocks[layout.curveOf[n * numRowBlocks:(n + 1) * numRowBlocks]] = rowBlocks
+
+        return blocks, layout
+
+    def getSubImageBlocks(self, bigImageData, step=[40] * 3, overlap=[0] * 3, order='raster'):
+        """
+        Split a big `vtkImageData` into sub-`vtkImageData` without a VTK
+        pipeline per block. Every block is one copy of its voxels into a
+        contiguous buffer shared with its image, or no copy at all when the
+        block is already contiguous (whole slices).
+        The sub-images keep the extent, origin and spacing of the big image,
+        as the output of `vtkExtractVOI`.
+        @param order    numbering of the blocks, see `getBlockInfo`
+        @return 1       a tuple of sub-`vtkImageData`, by sn
+        @return 2       objdict of parallel arrays, see `getBlockInfo`
+        """
+        bigMatrix = self.getNdarray(bigImageData)
+        bigExtent = bigImageData.GetExtent()
+        spacing = bigImageData.GetSpacing()
+        origin = bigImageData.GetOrigin()
+
+        startTime = time.time()
+        blockInfo = self.getBlockInfo(bigMatrix.shape, step, overlap, order)
+
+        subImages = []
+        for voi, extent in zip(blockInfo.vois, blockInfo.extents):
+            subMatrix = np.ascontiguousarray(
+                bigMatrix[voi[0]:voi[1], voi[2]:voi[3], voi[4]:voi[5]])
+            subImages.append(self.vtkImageDataFromNdarray(
+                subMatrix, spacing, origin, extent + np.repeat(bigExtent[::2], 2)))
+        logging.debug("--- getSubImageBlocks of %d blocks uses %s seconds ---" %
+                      (len(subImages), time.time() - startTime))
+
+        return tuple(subImages), blockInfo
+
+    def getSubImageList(self, bigImageData, step=[40] * 3, overlap=[0] * 3, order='raster'):
+        """
+        Retrieve a tuple of sub-`vtkImageData` with `index`, `neighbours` and `sn` attached
+        NOTE: `getSubImageBlocks` gives the same images with the attributes as arrays
+        @param order        numbering of the blocks, see `getBlockInfo`
+        """
+
+        subImages, blockInfo = self.getSubImageBlocks(bigImageData, step, overlap, order)
+
+        indices = [tuple(int(i) for i in index) for index in blockInfo.indices]
+        for subImage, index, sn, neighbours in zip(
+                subImages, indices, blockInfo.sns, blockInfo.neighbours):
+            subImage.index = index
+            subImage.neighbours = tuple(None if n < 0 else indices[n] for n in neighbours)
+            subImage.sn = int(sn)
+
+        return subImages
+
+    def _prefetch(self, iterable, prefetch=4):
+        """
+        Iterate on a background thread, at most `prefetch` items ahead of
+        the consumer. The thread waits while the queue is full (back-pressure),
+        and stops when the consumer closes or drops the generator.
+        Exceptions of the thread are raised in the consumer.
+        @param iterable     items to produce
+        @param prefetch     size of the queue, 0 produces in the caller
+        @yield              the items in order
+        """
+        if prefetch <= 0:
+            for item in iterable:
+                yield item
+            return
+
+        items = queue.Queue(maxsize=prefetch)
+        stopped = threading.Event()
+        end = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in iterable:
+                    if not put((item, None)):
+                        return
+                put((end, None))
+            except Exception as e:
+                put((end, e))
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item, error = items.get()
+                if item is end:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            stopped.set()
+            thread.join()
+
+    def iterSubMatrices(self, volumeNode, step=[40] * 3, overlap=[0] * 3, order='raster',
+                        prefetch=4):
+        """
+        Stream the blocks of a volume, one contiguous copy at a time, instead
+        of materialising all of them. The next `prefetch` blocks are read on
+        a background thread, so a downstream stage starts on the first block
+        at once; memory is bounded by the prefetch window.
+        Usage:
+            ```
+            for block in logic.iterSubMatrices(volumeNode, step, order='hilbert'):
+                coords = logic.getCoords(block.matrix)
+            ```
+        @param volumeNode   `vtkMRMLScalarVolumeNode`, `vtkImageData` or ndarray
+        @param order        traversal order, see `getBlockOrder`
+        @param prefetch     number of blocks read ahead, 0 reads in the caller
+        @yield              objdict of `sn`, `index`, `voi`, `extent`,
+                            `neighbours` (see `getBlockInfo`) and `matrix`
+        """
+        bigMatrix = self.getNdarray(volumeNode)
+        blockInfo = self.getBlockInfo(bigMatrix.shape, step, overlap)
+
+        def readBlocks():
+            for sn in self.getBlockOrder(blockInfo.grid, order):
+                voi = blockInfo.vois[sn]
+                matrix = np.ascontiguousarray(
+                    bigMatrix[voi[0]:voi[1], voi[2]:voi[3], voi[4]:voi[5]])
+                yield objdict(sn=int(sn), index=tuple(blockInfo.indices[sn]), voi=voi,
+                              extent=blockInfo.extents[sn],
+                              neighbours=blockInfo.neighbours[sn], matrix=matrix)
+
+        return self._prefetch(readBlocks(), prefetch)
+
+    def iterSubImages(self, bigImageData, step=[40] * 3, overlap=[0] * 3, order='raster',
+                      prefetch=4):
+        """
+        Stream of sub-`vtkImageData` with `index`, `neighbours` and `sn`
+        attached, the lazy counterpart of `getSubImageList`
+        """
+        bigExtent = np.repeat(bigImageData.GetExtent()[::2], 2)
+        spacing = bigImageData.GetSpacing()
+        origin = bigImageData.GetOrigin()
+        shape = self.getNdarray(bigImageData).shape
+        grid = [(n + s - 1) // s for n, s in zip(shape, step)]
+
+        for block in self.iterSubMatrices(bigImageData, step, overlap, order, prefetch):
+            subImage = self.vtkImageDataFromNdarray(block.matrix, spacing, origin,
+                                                    block.extent + bigExtent)
+            subImage.index = tuple(int(i) for i in block.index)
+            subImage.neighbours = tuple(
+                None if n < 0 else tuple(int(i) for i in np.unravel_index(n, grid))
+                for n in block.neighbours)
+            subImage.sn = block.sn
+            yield subImage
+
+    def iterBlockCoords(self, volumeNode, step=[40] * 3, overlap=[0] * 3, range=[90, 100],
+                        ratio=0.1, order='raster', prefetch=4):
+        """
+        Stream (sn, coords) of the valid blocks, ready for `fitBlocks`
+        @param range        a grey value range, see `getCoords`
+        @param ratio        least ratio of in-range points, invalid blocks are skipped
+        @yield              (sn, coords), coords local to the block
+        """
+        for block in self.iterSubMatrices(volumeNode, step, overlap, order, prefetch):
+            matrix = block.matrix
+            coords = np.transpose(((matrix >= range[0]) & (matrix <= range[1])).nonzero())
+            if len(coords) >= ratio * matrix.size:
+                yield block.sn, coords
+
+    def ndarrayFromVtkImageData(self, imageData):
+        """
+        The scalars of a `vtkImageData` as a [z, y, x] ndarray, no copy.
+        The ndarray keeps the VTK array alive through the buffer interface.
+        @return ndarray     (z, y, x), or (z, y, x, components)
+        """
+        scalars = imageData.GetPointData().GetScalars()
+        if scalars is None:
+            raise TypeError("No scalars in the vtkImageData")
+
+        shape = list(imageData.GetDimensions())
+        shape.reverse()
+        if scalars.GetNumberOfComponents() > 1:
+            shape.append(scalars.GetNumberOfComponents())
+
+        return numpy_support.vtk_to_numpy(scalars).reshape(shape)
+
+    def vtkImageDataFromNdarray(self, ndarray, spacing=[1, 1, 1], origin=[0, 0, 0],
+                                extent=None):
+        """
+        A `vtkImageData` sharing the buffer of a [z, y, x] ndarray, the order
+        `getNdarray` returns. The native dtype is kept.
+        The ndarray is copied only if it is not C-contiguous or its dtype has
+        no VTK counterpart, and the reason is logged.
+        The vtkImageData holds a reference to the buffer, so the ndarray does
+        not have to be kept by the caller.
+        @param ndarray      (z, y, x), or (z, y, x, components)
+        @param extent       extent of the image, its dimensions must agree
+                            with the ndarray. From 0 by default.
+        @return vtkImageData
+        """
+        if ndarray.ndim not in (3, 4):
+            raise TypeError("a 3D ndarray, or 4D with components, is required")
+
+        reasons = []
+        dtype = ndarray.dtype
+        if not dtype.isnative:
+            reasons.append("byte order")
+            dtype = dtype.newbyteorder('=')
+        if dtype.kind not in 'iuf' or dtype.itemsize not in (1, 2, 4, 8) or \
+                (dtype.kind == 'f' and dtype.itemsize < 4):
+            reasons.append("dtype " + str(dtype))
+            dtype = np.dtype(np.uint8 if dtype.kind == 'b' else
+                             np.float32 if dtype.kind == 'f' else np.float64)
+        if not ndarray.flags.c_contiguous:
+            reasons.append("strides")
+        if reasons:
+            logging.info("vtkImageDataFromNdarray: the ndarray is copied for its " +
+                         ", ".join(reasons))
+            ndarray = np.ascontiguousarray(ndarray, dtype=dtype)
+
+        numComponents = ndarray.shape[3] if ndarray.ndim == 4 else 1
+        vtkArray = numpy_support.numpy_to_vtk(
+            ndarray.reshape(-1, numComponents) if numComponents > 1 else
+            ndarray.reshape(-1), deep=False)
+
+        imageData = vtk.vtkImageData()
+        if extent is None:
+            imageData.SetDimensions(ndarray.shape[2], ndarray.shape[1], ndarray.shape[0])
+        else:
+            imageData.SetExtent(extent)
+            if imageData.GetDimensions() != ndarray.shape[2::-1]:
+                raise ValueError("The extent disagrees with the ndarray", extent)
+        imageData.SetSpacing(spacing)
+        imageData.SetOrigin(origin)
+        imageData.GetPointData().SetScalars(vtkArray)
+        imageData._numpy_reference = ndarray  # keep the buffer alive
+
+        return imageData
+
+    def _getVolumeKey(self, node):
+        """
+        A key of the volume for the caches. A NRRD file is known by the
+        modification time and size of its header and of its data file, a VTK
+        object by its address and `GetMTime`, which `Modified()` updates.
+        NOTE: an ndarray is known by its `id` only, an in-place edit is not seen
+        """
+        if isinstance(node, np.ndarray):
+            return ('ndarray', id(node), node.shape, node.dtype.str)
+        if isinstance(node, _stringTypes):
+            filePath = os.path.abspath(node)
+            dataFile = self.readNrrdHeader(filePath).dataFile
+            return ('file',) + tuple((path, os.path.getmtime(path), os.path.getsize(path))
+                                     for path in sorted(set((filePath, dataFile))))
+
+        imageData = node if node.IsA('vtkImageData') else node.GetImageData()
+        return (node.GetClassName(),
+                imageData.GetAddressAsString('vtkImageData'),
+                imageData.GetMTime())
+
+    def getContentHash(self, node):
+        """
+        SHA-1 of the shape, type and voxels of a volume, slab by slab so a
+        memory-mapped volume is not read in as a whole.
+        The hash of a file or a VTK object is remembered by `_getVolumeKey`,
+        that of an ndarray is computed on every call, as an in-place edit
+        cannot be told from its `id`.
+        @param node         volume node, `vtkImageData`, ndarray or file path
+        @return str         hex digest
+        """
+        key = None if isinstance(node, np.ndarray) else self._getVolumeKey(node)
+        cache = DivideImageLogic._contentHashes
+        if key is not None and key in cache:
+            cache[key] = cache.pop(key)  # the latest used is the last
+            return cache[key][1]
+
+        startTime = time.time()
+        bigMatrix = self.getNdarray(node)
+        sha1 = hashlib.sha1(repr((bigMatrix.shape, bigMatrix.dtype.str)).encode('ascii'))
+        slabSize = max(1, (1 << 24) // max(bigMatrix[:1].nbytes, 1))
+        for i in np.arange(0, len(bigMatrix), slabSize):
+            sha1.update(np.ascontiguousarray(bigMatrix[i:i + slabSize]).tobytes())
+        contentHash = sha1.hexdigest()
+        logging.debug("--- getContentHash uses %s seconds ---" % (time.time() - startTime))
+
+        if key is not None:
+            cache[key] = (node, contentHash)  # keep a VTK object alive, so its address is not reused
+            while len(cache) > DivideImageLogic._numContentHashes:
+                cache.popitem(last=False)
+
+        return contentHash
+
+    def getBlockStore(self, node, step=[40] * 3, overlap=[0] * 3, root=None):
+        """
+        Get the on-disk `BlockStore` of a volume divided by `step` and `overlap`,
+        the stored blocks, coords and fits of earlier sessions are reused.
+        Usage:
+            ```
+            blockStore = logic.getBlockStore(volumeNode, step)
+            vectors = blockStore.fitValid(range=[90, 100])
+            ```
+        @param node         volume node, `vtkImageData`, ndarray or file path
+        @param root         directory of all stores, in the Slicer temporary
+                            path by default
+        @return BlockStore
+        """
+        if root is None:
+            root = os.path.join(slicer.app.temporaryPath, 'DivideImage')
+        bigMatrix = self.getNdarray(node)
+
+        path = BlockStore.create(root, self.getContentHash(node), bigMatrix.shape,
+                                 bigMatrix.dtype, step, overlap)
+        return BlockStore(path, bigMatrix)
+
+    def getIntegralVolume(self, node, range=[90, 100]):
+        """
+        Get the `IntegralVolume` of a volume, built once per volume and range
+        @param node         volume node, `vtkImageData` or ndarray
+        @param range        a grey value range
+        @return IntegralVolume
+        """
+        key = self._getVolumeKey(node) + (tuple(range),)
+        cache = DivideImageLogic._integralVolumes
+
+        if key in cache:
+            source, integralVolume = cache.pop(key)
+        else:
+            startTime = time.time()
+            source = node  # keep the ndarray alive, so its `id` is not reused
+            integralVolume = IntegralVolume(self.getNdarray(node), range)
+            logging.debug("--- IntegralVolume uses %s seconds ---" %
+                          (time.time() - startTime))
+
+        cache[key] = (source, integralVolume)  # the latest used is the last
+        while len(cache) > DivideImageLogic._numIntegralVolumes:
+            cache.popitem(last=False)
 
-        return subImage  # still `vtkImageData`, but attached `index`, `neighbours` and `sn`
+        return integralVolume
 
-    def getSubImageList(self, bigImageData, step=[40] * 3, overlap=[0] * 3):
+    def clearIntegralVolumes(self, node=None):
         """
-        Retrieve a tuple of sub-`vtkImageData` with `index`, `neighbours` and `sn` attached
+        Free the cached `IntegralVolume`s of a volume, or of all volumes
+        @param node         volume node, `vtkImageData` or ndarray, None for all
+        """
+        cache = DivideImageLogic._integralVolumes
+        for key, (source, _) in list(cache.items()):
+            if node is None or source is node:
+                del cache[key]
+
+    def getBlockView(self, bigMatrix, step=[40] * 3):
         """
+        View the big matrix as a 6D array of blocks without copying
+        Only the complete blocks are covered, ragged edges are dropped.
+        @param bigMatrix    a 3D array
+        @param step         shape of subMatrix
+        @return ndarray     (nz, ny, nx, sz, sy, sx) strided view of `bigMatrix`
+                            `view[i, j, k]` is the subMatrix of index (i, j, k)
+        """
+        if bigMatrix.ndim != 3:
+            raise TypeError("a 3D array is required")
+
+        step = tuple(int(s) for s in step)
+        grid = tuple(n // s for n, s in zip(bigMatrix.shape, step))
+        strides = tuple(t * s for t, s in zip(bigMatrix.strides, step))
+
+        return np.lib.stride_tricks.as_strided(
+            bigMatrix, shape=grid + step, strides=strides + bigMatrix.strides,
+            writeable=False)
 
-        extentIndexSn = []
+    def getValidBlockGrid(self, node, step=[40] * 3, range=[90, 100], ratio=0.1):
+        """
+        Mark the validity of all subMatrices at once, the same standard as
+        `isValidMatrix`, without slicing the big matrix block by block.
+        The in-range mask is padded to a multiple of `step`, so the ragged
+        edge blocks are counted by the same 6D view as the complete ones.
+        @param node         volume node, `vtkImageData` or ndarray
+        @param step         shape of subMatrix
+        @param range        a grey value range
+        @param ratio        least ratio of in-range points of a valid block
+        @return 1           (nz, ny, nx) boolean validity grid
+        @return 2           (nz, ny, nx) number of in-range points per block
+        """
+        bigMatrix = self.getNdarray(node)
+        shape = bigMatrix.shape
+        step = [int(s) for s in step]
+        grid = [-(-n // s) for n, s in zip(shape, step)]  # ceil division
+
+        # One slab of blocks at a time, so a memory-mapped volume is not
+        # read in as a whole. The padding is never in the range, so it does not count.
+        counts = np.zeros(grid, dtype=np.int64)
+        mask = np.zeros([step[0], grid[1] * step[1], grid[2] * step[2]], dtype=bool)
+        for n, i in enumerate(np.arange(0, shape[0], step[0])):
+            slab = bigMatrix[i:i + step[0]]
+            inRange = mask[:len(slab), :shape[1], :shape[2]]
+            np.greater_equal(slab, range[0], out=inRange)
+            inRange &= slab <= range[1]
+            mask[len(slab):] = False  # the ragged last slab
+
+            counts[n] = self.getBlockView(mask, step).sum(axis=(3, 4, 5))[0]
+
+        # Number of voxels of each block, smaller at the ragged edges
+        sizes = [np.minimum(s, n - np.arange(0, n, s)) for n, s in zip(shape, step)]
+        numItems = (sizes[0][:, None, None] * sizes[1][None, :, None] *
+                    sizes[2][None, None, :])
+        isValidGrid = counts >= ratio * numItems
+
+        return isValidGrid, counts
+
+    def getBlockHistogram(self, node, step=[40] * 3, numBins=256):
+        """
+        Scan the volume once for the grey value histograms of all blocks,
+        then `isValidGrid(range, ratio)` can be asked for any range.
+        @param node         volume node, `vtkImageData` or ndarray
+        @param step         shape of subMatrix
+        @param numBins      number of bins of every histogram
+        @return BlockHistogram
+        """
         startTime = time.time()
-        for i in self._getSubImageInfo(bigImageData, step, overlap):
-            extentIndexSn.append(i)
-        logging.debug("--- getSubImageInfo uses %s seconds ---" % (time.time() - startTime))
+        blockHistogram = BlockHistogram(self.getNdarray(node), step, numBins)
+        logging.debug("--- BlockHistogram uses %s seconds ---" %
+                      (time.time() - startTime))
+
+        return blockHistogram
+
+    def getCoordsStore(self, node, step=[40] * 3, range=[90, 100]):
+        """
+        Get the coords of in-range points of ALL subMatrices at once.
+        The volume is thresholded one slab of blocks at a time, the points of
+        a slab are bucketed by block with a stable sort, and appended to
+        one contiguous array.
+        @param node         volume node, `vtkImageData` or ndarray
+        @param step         shape of subMatrix
+        @param range        a grey value range
+        @return BlockPointStore
+        """
+        bigMatrix = self.getNdarray(node)
+        shape = bigMatrix.shape
+        step = [int(s) for s in step]
+        grid = [-(-n // s) for n, s in zip(shape, step)]  # ceil division
+        numPlaneBlocks = grid[1] * grid[2]
+        coordType = np.int16 if max(step) <= np.iinfo(np.int16).max else np.int32
 
-        # Get sub-image
         startTime = time.time()
-        r = map(self._getSubImage, extentIndexSn)
-        logging.debug("--- getSubImage uses %s seconds ---" % (time.time() - startTime))
+        slabCoords = []
+        counts = np.zeros(grid[0] * numPlaneBlocks, dtype=np.int64)
+        for i in np.arange(grid[0]):
+            slab = bigMatrix[i * step[0]:(i + 1) * step[0]]
+            z, y, x = np.nonzero((slab >= range[0]) & (slab <= range[1]))
+
+            planeSn = (y // step[1]) * grid[2] + x // step[2]
+            order = np.argsort(planeSn, kind='mergesort')  # stable
+
+            coords = np.empty((len(order), 3), dtype=coordType)
+            coords[:, 0] = z[order]  # a slab is one block thick
+            coords[:, 1] = (y % step[1])[order]
+            coords[:, 2] = (x % step[2])[order]
+            slabCoords.append(coords)
+
+            counts[i * numPlaneBlocks:(i + 1) * numPlaneBlocks] = np.bincount(
+                planeSn, minlength=numPlaneBlocks)
+
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        sizes = [np.minimum(s, n - np.arange(0, n, s)) for n, s in zip(shape, step)]
+        numItems = (sizes[0][:, None, None] * sizes[1][None, :, None] *
+                    sizes[2][None, None, :]).ravel()
 
-        return tuple(r)
+        pointStore = BlockPointStore(np.concatenate(slabCoords), offsets,
+                                     grid, step, numItems)
+        logging.debug("--- getCoordsStore uses %s seconds, %d points ---" %
+                      (time.time() - startTime, offsets[-1]))
+
+        return pointStore
 
     def getValidSubMatrices(self, volumeNode, step=[40] * 3):
         """
@@ -1257,20 +3590,15 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
 
         bigMatrix = self.getNdarray(volumeNode)
         shape = bigMatrix.shape
-        subMatrices = []
-        isValidSubMatrices = []
 
-        for i in range(0, shape[0], step[0]):
-            for j in range(0, shape[1], step[1]):
-                for k in range(0, shape[2], step[2]):
-                    subMatrix = bigMatrix[i:i + step[0],
-                                          j:j + step[1],
-                                          k:k + step[2]
-                                          ]
-                    subMatrices.append(subMatrix)  # 1D list
+        subMatrices = [bigMatrix[i:i + step[0], j:j + step[1], k:k + step[2]]
+                       for i in range(0, shape[0], step[0])
+                       for j in range(0, shape[1], step[1])
+                       for k in range(0, shape[2], step[2])]  # 1D list
 
-                    isValid = self.isValidMatrix(subMatrix)
-                    isValidSubMatrices.append(isValid)  # 1D boolen list
+        # REVIEW: one reduction for all blocks, no more `isValidMatrix` per block
+        isValidGrid, _ = self.getValidBlockGrid(bigMatrix, step)
+        isValidSubMatrices = isValidGrid.ravel()  # 1D boolen array, same order
 
         logging.debug("%d subMatrices generated" % len(subMatrices))
 
@@ -1292,14 +3620,15 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
             logging.debug("Dimension of the give subMatix is not 3!")
             return False
 
-    def isValidMatrix(self, subMatrix, range=[90, 100]):
+    def isValidMatrix(self, subMatrix, range=[90, 100], ratio=0.1):
         """
         Determine the validation of subMatrix with a standard
         The standard could be complex
         This function is for testing ALL subMatrices
         @param subMatrix    test array
         @param range        a grey value range
-        @return boolen      `True` if contains at least 10% points in the range
+        @param ratio        least ratio of in-range points, 10% by default
+        @return boolen      `True` if contains at least `ratio` points in the range
         """
         # numItem = len(subMatrix)  # Wrong!
         numItem = subMatrix.size
@@ -1318,19 +3647,19 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
 
         logging.debug("Number of valid point: " + str(num))  # SLOW!!
 
-        ratio = float(num) / numItem
-        if ratio >= 0.1:
+        if float(num) / numItem >= ratio:
             return True
         else:
             return False
 
-    def getCoords(self, subMatrix, range=[90, 100]):
+    def getCoords(self, subMatrix, range=[90, 100], ratio=0.1):
         """
         Get the coords of valid point from a subMatrix
         This function is for testing ONE subMatrix.
         NOTE: `implicitFitting` requires `ndarray`
         @param subMatrix    array containing valide points
         @param range        a grey value range
+        @param ratio        least ratio of in-range points, 10% by default
         @return ndarray     a n*3 numpy array
         @retrun False       invalid array
         """
@@ -1357,9 +3686,9 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
         # print coords.shape
 
         # ratio = len(coords) / len(subMatrix)  # Wrong!
-        ratio = float(len(coords)) / subMatrix.size  # NOTE: the division
-        logging.debug("ratio: " + str(ratio))
-        if ratio >= 0.1:
+        validRatio = float(len(coords)) / subMatrix.size  # NOTE: the division
+        logging.debug("ratio: " + str(validRatio))
+        if validRatio >= ratio:
             logging.debug("Valid subMatrix")
             # return np.asarray(coords)  # type 'numpy.ndarray'
             return coords
@@ -1393,42 +3722,103 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
         logic.UpdateDisplayNodeFromVolumeNode(displayNode, volumeNode)
         volumeNode.AddAndObserveDisplayNodeID(displayNode.GetID())
 
-    def implicitFitting(self, data):
+    def _fillDistanceMatrix(self, data, out, chunkSize=256):
         """
-        Find the fitting according to input dataset
-        @param data     point_num*3 array, every row is a 3D point
-        @return ndarray colume vector: point_num*1
+        Fill `out` with the pairwise distances of the points, a chunk of rows
+        at a time, so the temporary memory is bounded by `chunkSize` rows
+        @param data         point_num*3 array, every row is a 3D point
+        @param out          point_num*point_num array, can be a view
+        @param chunkSize    number of rows computed at once
         """
-
         num_points = len(data)
+        squared = np.empty((min(chunkSize, num_points), num_points))
+
+        for start in range(0, num_points, chunkSize):
+            stop = min(start + chunkSize, num_points)
+            rows = squared[:stop - start]
+            rows.fill(0)
+            for axis in range(3):
+                diff = data[start:stop, axis, None] - data[None, :, axis]
+                diff *= diff
+                rows += diff
+            np.sqrt(rows, out=out[start:stop])
+
+        return out
+
+    def _solveSchurBlock(self, M11, M12, solver='solve', tolerance=None):
+        """
+        Solve `M11 * M0 = M12` for the 6-column Schur complement
+        @param solver
+            'solve' - LU factorisation against the 6 right-hand sides,
+                      falls back to 'pinv' if M11 is singular or the
+                      normwise backward error exceeds `tolerance`
+            'pinv'  - SVD pseudo-inverse of M11, O(n^3) with a large constant
+        @param tolerance    bound of `|M11 * M0 - M12| / (|M11| |M0| + |M12|)`,
+                            None for `len(M11)` machine epsilons of M11's dtype
+        @return ndarray     the same shape as M12
+        """
+        if tolerance is None:
+            tolerance = len(M11) * np.finfo(M11.dtype).eps
+
+        if solver == 'solve':
+            try:
+                M0 = np.linalg.solve(M11, M12)
+                residual = (np.linalg.norm(np.dot(M11, M0) - M12) /
+                            (np.linalg.norm(M11) * np.linalg.norm(M0) +
+                             np.linalg.norm(M12)))
+                if residual <= tolerance:
+                    return M0
+                logging.info("Ill-conditioned RBF system (residual %g), "
+                             "fall back to pinv" % residual)
+            except np.linalg.LinAlgError:
+                logging.info("Singular RBF system, fall back to pinv")
+        elif solver != 'pinv':
+            raise ValueError("solver must be 'solve' or 'pinv'", solver)
+
+        pinvM11 = np.linalg.pinv(M11)
+        return np.dot(pinvM11, M12)
+
+    def implicitFitting(self, data, dtype=np.float64, chunkSize=256, solver='solve',
+                        k=None):
+        """
+        Find the fitting according to input dataset
+        @param data         point_num*3 array, every row is a 3D point
+        @param dtype        float type of the system, `np.float32` halves memory
+        @param chunkSize    rows of the distance matrix computed at once
+        @param solver       'solve' (LU, default) or 'pinv', see `_solveSchurBlock`
+        @param k            of the ellipsoid constraint, drawn from `np.random`
+                            if None
+        @return ndarray     colume vector: point_num*1
+        """
 
-        A = np.zeros((num_points, num_points))
+        if k is None:
+            k = np.random.randint(4, 10000)
 
-        for i in range(num_points):
-            for j in range(i + 1, num_points):
-                A[i, j] = np.linalg.norm(data[i, :] - data[j, :])
-                A[j, i] = A[i, j]
+        return self._fitEllipsoidConstrained(data, int(k), dtype, chunkSize, solver)
 
-        # NOTE: it's no use to transpose a 1D array
-        # dx = data[:, 0].reshape(num_points, 1)
-        # dy = data[:, 1].reshape(num_points, 1)
-        # dz = data[:, 2].reshape(num_points, 1)
+    @_memoized
+    def _fitEllipsoidConstrained(self, data, k, dtype, chunkSize, solver):
+        """
+        `implicitFitting` with a given `k`, memoised since it is deterministic
+        """
 
-        dx = data[:, 0][None].T
-        dy = data[:, 1][None].T
-        dz = data[:, 2][None].T
+        data = np.asarray(data, dtype=np.float64)
+        num_points = len(data)
 
-        B = np.hstack((np.ones((num_points, 1)),
-                       2 * dx, 2 * dy, 2 * dz,
-                       2 * dx * dy, 2 * dx * dz, 2 * dy * dz,
-                       dx * dx, dy * dy, dz * dz)
-                      )
+        # M = [[A, B], [B.T, 0]], filled in place. It is sysmmetric
+        M = np.zeros((num_points + 10, num_points + 10), dtype=dtype)
+        self._fillDistanceMatrix(data, M[:num_points, :num_points], chunkSize)
 
-        M_t1 = np.concatenate((A, B.T))
-        M_t2 = np.concatenate((B, np.zeros((10, 10))))
-        M = np.concatenate((M_t1, M_t2), axis=1)  # It is sysmmetric
+        dx, dy, dz = data.T
+        B = M[:num_points, num_points:]
+        B[:, 0] = 1
+        B[:, 1:4] = 2 * data
+        B[:, 4] = 2 * dx * dy
+        B[:, 5] = 2 * dx * dz
+        B[:, 6] = 2 * dy * dz
+        B[:, 7:] = data * data
+        M[num_points:, :num_points] = B.T
 
-        k = np.random.randint(4, 10000)
         C0 = np.zeros((3, 3))
         C1 = np.diag([-k] * 3)
         C2 = np.ones((3, 3)) * (k - 2) / 2.0
@@ -1442,8 +3832,7 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
         M12 = M[0:-6, -6:]  # (num_point-6) * 6
         M22 = M[-6:, -6:]  # 6 * 6 zero matrix
 
-        pinvM11 = np.linalg.pinv(M11)
-        M0 = np.dot(pinvM11, M12)
+        M0 = self._solveSchurBlock(M11, M12, solver)
         M00 = M22 - np.dot(M12.T, M0)
 
         eigen_value, eigen_vec = np.linalg.eig(np.dot(invC, M00))
@@ -1458,54 +3847,628 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
 
         return vector
 
-    #
-    # RBF Ellipsoid fitting
-    def radialBasisFunc(self, vector, data, step=0.1):
+    def fitPartitionOfUnity(self, node, step=[40] * 3, overlap=[0] * 3,
+                            range=[90, 100], ratio=0.1, maxPoints=None,
+                            processes=None):
         """
-        Radial Basis Function fitting
-        @param vector   found fitting
-        @param data     point_num*3 array, every row is a 3D point
-        @return1        a ndarray object in ndarray format
-        @return2        spacing
+        Fit every valid block with its overlap and blend them into one
+        global implicit function, the cost grows linearly with the blocks.
+        @param node         volume node, `vtkImageData` or ndarray
+        @param step         shape of subMatrix
+        @param overlap      added at the end of step, see `_getSubImageInfo`
+        @param range        a grey value range
+        @param ratio        least ratio of in-range points of a valid block
+        @param maxPoints    cap of points per block, see `decimateCoords`
+        @param processes    see `fitBlocks`
+        @return PartitionOfUnityFit
         """
+        bigMatrix = self.getNdarray(node)
+        isValidGrid = self.getIntegralVolume(node, range).isValidGrid(
+            step, overlap, ratio)
+
+        blocks, indices = [], {}
+        for extentIndexSn in self._getSubImageInfo(bigMatrix, step, overlap):
+            index, sn = extentIndexSn[6:-1], extentIndexSn[-1]
+            if not isValidGrid[index]:
+                continue
+            e = extentIndexSn[:6]
+            subMatrix = bigMatrix[e[4]:e[5] + 1, e[2]:e[3] + 1, e[0]:e[1] + 1]
+            coords = self.getCoords(subMatrix, range, ratio)
+            if maxPoints:
+                coords, _ = self.decimateCoords(coords, maxPoints)
+            blocks.append((sn, coords))
+            indices[sn] = index
 
-        w = vector[-10:]
-        num_points = len(data)
+        startTime = time.time()
+        coords = dict(blocks)
+        pouFit = PartitionOfUnityFit(isValidGrid.shape, step, overlap)
+        for sn, vector in self.fitBlocks(blocks, processes):
+            pouFit.addFit(indices[sn], coords[sn], vector)
+        pouFit.orient()
+        logging.debug("--- fitPartitionOfUnity of %d blocks uses %s seconds ---" %
+                      (len(pouFit), time.time() - startTime))
+
+        return pouFit
+
+    def _getFittingChunks(self, blocks, numChunks):
+        """
+        Group blocks into chunks of about the same fitting cost, which grows
+        with the cube of the number of points. The largest blocks come first
+        and go alone, the small ones are packed together.
+        @param blocks       a list of (sn, coords)
+        @return list        a list of chunks, every chunk is a list of (sn, coords)
+        """
+        blocks = sorted(blocks, key=lambda block: len(block[1]), reverse=True)
+        costs = [float(len(coords)) ** 3 for _, coords in blocks]
+        targetCost = sum(costs) / max(numChunks, 1)
+
+        chunks = []
+        chunk, chunkCost = [], 0.0
+        for block, cost in zip(blocks, costs):
+            if chunk and chunkCost + cost > targetCost:
+                chunks.append(chunk)
+                chunk, chunkCost = [], 0.0
+            chunk.append(block)
+            chunkCost += cost
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    def fitBlocks(self, blocks, processes=None, dtype=np.float64, solver='solve',
+                  ratio=0.1, seed=None):
+        """
+        Fit many blocks on a process pool, results are yielded as they come.
+        Processes rather than threads, so all cores run the LAPACK work.
+        NOTE: every worker runs its BLAS on one thread if `threadpoolctl` is
+        installed. Without it, a multithreaded BLAS oversubscribes the cores,
+        set `OMP_NUM_THREADS=1` (or `OPENBLAS_NUM_THREADS`, `MKL_NUM_THREADS`)
+        before Slicer starts, or pass fewer `processes`.
+        Usage:
+            ```
+            pointStore = logic.getCoordsStore(volumeNode, step)
+            for sn, vector in logic.fitBlocks(pointStore):
+                vectors[sn] = vector
+            ```
+        @param blocks       a `BlockPointStore`, whose valid blocks are fitted,
+                            a list of (sn, coords), or a stream of them such
+                            as `iterBlockCoords`, which is read a few blocks
+                            per process ahead of the fitting
+        @param processes    number of worker processes, all cores by default,
+                            0 fits in this process
+        @param dtype        see `implicitFitting`
+        @param solver       see `implicitFitting`
+        @param ratio        validity standard of the blocks of a `BlockPointStore`
+        @param seed         if not None, the `k` of each block comes from
+                            `seed + sn`, so the fittings are reproducible, cached
+                            or not, and the same for any `processes`
+        @yield              (sn, vector), in the order of completion
+        """
+        if isinstance(blocks, BlockPointStore):
+            pointStore = blocks
+            blocks = [(sn, pointStore.getCoords(sn))
+                      for sn in np.flatnonzero(pointStore.isValid(ratio))]
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        # A list is fitted at once, a stream in windows of a few blocks per process
+        if isinstance(blocks, (list, tuple)):
+            windows = [blocks]
+        else:
+            blocks = iter(blocks)
+            windowSize = max(processes, 1) * 4
+            windows = iter(lambda: list(itertools.islice(blocks, windowSize)), [])
+
+        startTime = time.time()
+        numBlocks = 0
+        if not processes:
+            for window in windows:
+                for sn, coords in window:
+                    numBlocks += 1
+                    yield sn, self.implicitFitting(np.ascontiguousarray(coords), dtype=dtype,
+                                                   solver=solver, k=_getBlockK(seed, sn))
+            logging.debug("--- fitBlocks of %d blocks uses %s seconds ---" %
+                          (numBlocks, time.time() - startTime))
+            return
+
+        # One `imap_unordered` over all the windows, so none waits for the last
+        # one. Its task thread reads the tasks eagerly, the semaphore keeps it
+        # to a bounded number of chunks whose results are not back yet
+        numOutstanding = threading.Semaphore(processes * 8)
+        stopped = []
+
+        def getTasks():
+            for window in windows:
+                window = [(sn, np.ascontiguousarray(coords)) for sn, coords in window]
+                # A few chunks per process, so the load is balanced at the end
+                for chunk in self._getFittingChunks(window, processes * 4):
+                    numOutstanding.acquire()
+                    if stopped:
+                        return
+                    yield chunk, dtype, solver, seed
+
+        pool = Pool(processes, _initFitWorker)
+        try:
+            for results in pool.imap_unordered(_fitBlockChunk, getTasks()):
+                numOutstanding.release()
+                for sn, vector in results:
+                    numBlocks += 1
+                    yield sn, vector
+            pool.close()
+        finally:
+            # Let a waiting task thread end, `terminate` joins it
+            stopped.append(True)
+            numOutstanding.release()
+            pool.terminate()
+            pool.join()
+
+        logging.debug("--- fitBlocks of %d blocks uses %s seconds ---" %
+                      (numBlocks, time.time() - startTime))
+
+    def evaluateRBF(self, vector, data, points, chunkSize=None, withGradient=False,
+                    treecode=None):
+        """
+        Evaluate the fitted implicit function at any points
+        @param vector       found fitting, see `implicitFitting`
+        @param data         point_num*3 array, the centres of the fitting
+        @param points       m*3 array, where to evaluate
+        @param chunkSize    number of points against all centres at once,
+                            by default about 1 MB of distances
+        @param withGradient also return the m*3 gradient, always exact
+        @param treecode     an `RBFTreecode` of `data` and the weights of
+                            `vector`, approximates the radial part
+        @return ndarray     m values, and m*3 gradient if `withGradient`
+        """
+        vector = np.real(np.asarray(vector)).ravel()
+        data = np.asarray(data, dtype=np.float64)
+        points = np.asarray(points, dtype=np.float64)
+        weights, w = vector[:-10], vector[-10:]
+
+        x, y, z = points.T
+        values = (w[0] + 2 * w[1] * x + 2 * w[2] * y + 2 * w[3] * z +
+                  2 * w[4] * x * y + 2 * w[5] * x * z + 2 * w[6] * y * z +
+                  w[7] * x * x + w[8] * y * y + w[9] * z * z)
+        if withGradient:
+            gradient = np.column_stack((
+                2 * (w[1] + w[4] * y + w[5] * z + w[7] * x),
+                2 * (w[2] + w[4] * x + w[6] * z + w[8] * y),
+                2 * (w[3] + w[5] * x + w[6] * y + w[9] * z)))
+
+        if treecode is not None and not withGradient:
+            return values + treecode.evaluate(points)
+
+        if chunkSize is None:
+            chunkSize = max(64, (1 << 17) // max(len(data), 1))
+
+        # |p - c|^2 = |p|^2 + |c|^2 - 2 p.c, a matrix product per chunk.
+        # Centred first to keep the cancellation small.
+        centre = data.mean(0)
+        data = data - centre
+        points = points - centre
+        dataNorms = np.einsum('ij,ij->i', data, data)
+        dataT = -2 * data.T
+
+        for start in range(0, len(points), chunkSize):
+            stop = min(start + chunkSize, len(points))
+            chunk = points[start:stop]
+            distance = np.dot(chunk, dataT)
+            distance += np.einsum('ij,ij->i', chunk, chunk)[:, None]
+            distance += dataNorms
+            np.maximum(distance, 0, out=distance)
+            np.sqrt(distance, out=distance)
+            values[start:stop] += np.dot(distance, weights)
+
+            if withGradient:
+                # d|p - c| / dp = (p - c) / |p - c|, taken as 0 at a centre
+                distance[distance < 1e-6] = np.inf
+                scaled = weights / distance
+                gradient[start:stop] += (chunk * scaled.sum(1)[:, None] -
+                                         np.dot(scaled, data))
+
+        if withGradient:
+            return values, gradient
+        return values
+
+    def decimateCoords(self, coords, maxPoints=1000, method='farthest', seed=0):
+        """
+        Cap the number of points before `implicitFitting`, whose cost grows
+        with the cube of the number of points. Deterministic for a `seed`.
+        @param coords       n*3 array
+        @param maxPoints    the most points kept
+        @param method
+            'farthest'  - farthest point sampling, even cover of the surface
+            'grid'      - one random point per cell of the coarsest voxel grid
+                          keeping no more than `maxPoints`, much faster
+        @param seed         seed of the random choices
+        @return 1           kept points, at most maxPoints*3
+        @return 2           held-out points, the rest
+        """
+        coords = np.asarray(coords)
+        num_points = len(coords)
+        if num_points <= maxPoints:
+            return coords, coords[:0]
+
+        randomState = np.random.RandomState(seed)
+        points = coords.astype(np.float64)
+
+        if method == 'farthest':
+            kept = np.empty(maxPoints, dtype=np.int64)
+            kept[0] = randomState.randint(num_points)
+            distance = np.full(num_points, np.inf)
+            for i in range(1, maxPoints):
+                diff = points - points[kept[i - 1]]
+                np.minimum(distance, np.einsum('ij,ij->i', diff, diff), out=distance)
+                kept[i] = np.argmax(distance)
+
+        elif method == 'grid':
+            order = randomState.permutation(num_points)  # random pick per cell
+            points = points[order] - points.min(0)
+
+            def pickCells(cellSize):
+                cells = np.floor(points / cellSize).astype(np.int64)
+                cellIds = (cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]) * \
+                    (cells[:, 2].max() + 1) + cells[:, 2]
+                return np.unique(cellIds, return_index=True)[1]
+
+            # Bisect the cell size down to the finest grid within the cap
+            low, high = 0.0, points.max() + 1.0
+            kept = pickCells(high)
+            for _ in range(20):
+                cellSize = (low + high) / 2
+                picked = pickCells(cellSize)
+                if len(picked) <= maxPoints:
+                    high, kept = cellSize, picked
+                else:
+                    low = cellSize
+            kept = np.sort(order[kept])
+
+        else:
+            raise ValueError("method must be 'farthest' or 'grid'", method)
+
+        isKept = np.zeros(num_points, dtype=bool)
+        isKept[kept] = True
+        return coords[isKept], coords[~isKept]
+
+    def getFittingError(self, vector, data, points):
+        """
+        Distance-like error of a fitting at points not used to fit,
+        `|f| / |grad f|` is the first-order distance to the zero level set
+        @param vector       found fitting
+        @param data         the points fitted
+        @param points       the held-out points
+        @return objdict     `rms`, `mean` and `max` error, `num` points
+        """
+        error = objdict(rms=0.0, mean=0.0, max=0.0, num=len(points))
+        if not len(points):
+            return error
+
+        values, gradient = self.evaluateRBF(vector, data, points, withGradient=True)
+        distance = np.abs(values) / np.maximum(
+            np.sqrt(np.sum(gradient * gradient, axis=1)), np.finfo(float).tiny)
+
+        error.rms = float(np.sqrt(np.mean(distance ** 2)))
+        error.mean = float(np.mean(distance))
+        error.max = float(np.max(distance))
+        return error
+
+    def implicitFittingDecimated(self, coords, maxPoints=1000, method='farthest',
+                                 seed=0, solver='solve'):
+        """
+        `implicitFitting` of at most `maxPoints` points of `coords`, the error
+        is measured on the points left out, to pick a cap for accuracy against
+        throughput.
+        @return 1       colume vector, see `implicitFitting`
+        @return 2       the points fitted
+        @return 3       objdict of the error on held-out points, `getFittingError`
+        """
+        kept, heldOut = self.decimateCoords(coords, maxPoints, method, seed)
+
+        startTime = time.time()
+        vector = self.implicitFitting(kept, solver=solver)
+        error = self.getFittingError(vector, kept, heldOut)
+        logging.debug("--- %d/%d points fitted in %s seconds, held-out rms error %g ---" %
+                      (len(kept), len(coords), time.time() - startTime, error.rms))
 
-        # Step
+        return vector, kept, error
+
+    def _getSampleGrid(self, data, step):
+        """
+        Sampling positions of `radialBasisFunc` around the points
+        @return 1       step_x, step_y, step_z, positions along every axis
+        @return 2       spacing
+        """
         data_min = data.min(0)
         data_max = data.max(0)
 
-        step = self.setStep()
         offset = 0.1
         step_x = np.arange(data_min[0] - offset, data_max[0] + offset, step)
         step_y = np.arange(data_min[1] - offset, data_max[1] + offset, step)
         step_z = np.arange(data_min[2] - offset, data_max[2] + offset, step)
 
-        x, y, z = np.meshgrid(step_x, step_y, step_z)
-
-        dim_x, dim_y, dim_z = x.shape
+        # NOTE: the shape of the output is that of `np.meshgrid(x, y, z)`
+        dim_x, dim_y, dim_z = len(step_y), len(step_x), len(step_z)
 
         spacing = [(data_max[0] - data_min[0]) / (dim_x - 1.0),
                    (data_max[1] - data_min[1]) / (dim_y - 1.0),
                    (data_max[2] - data_min[2]) / (dim_z - 1.0)]
 
-        poly = w[0] * np.ones((x.shape)) + \
-            2 * w[1] * x + 2 * w[2] * y + 2 * w[3] * z + \
-            2 * w[4] * x * y + 2 * w[5] * x * z + 2 * w[6] * y * z + \
-            w[7] * x * x + w[8] * y * y + w[9] * z * z
+        return (step_x, step_y, step_z), spacing
+
+    #
+    # RBF Ellipsoid fitting
+    @_memoized
+    def radialBasisFunc(self, vector, data, step=0.1, dtype=np.float32,
+                        tileSize=16384, chunkSize=None, tolerance=None):
+        """
+        Radial Basis Function fitting
+        The grid is evaluated tile by tile into a preallocated array, the full
+        meshgrid is never built.
+        @param vector       found fitting
+        @param data         point_num*3 array, every row is a 3D point
+        @param dtype        type of the output
+        @param tileSize     number of grid points of a tile
+        @param chunkSize    see `evaluateRBF`
+        @param tolerance    approximate with an `RBFTreecode` of this tolerance,
+                            for many centres. Exact by default.
+        @return1            a ndarray object in ndarray format
+        @return2            spacing
+        """
 
-        radial = np.zeros((x.shape))
-        for i in range(num_points):
-            radial = radial + vector[i] * np.sqrt(
-                (x - data[i, 0])**2 + (y - data[i, 1])**2 + (z - data[i, 2])**2)
+        treecode = None
+        if tolerance is not None:
+            treecode = RBFTreecode(data, np.real(vector).ravel()[:-10], tolerance)
+        step = self.setStep()
+        (step_x, step_y, step_z), spacing = self._getSampleGrid(data, step)
+
+        # Indexed as `np.meshgrid(step_x, step_y, step_z)`: [y, x, z]
+        shape = (len(step_y), len(step_x), len(step_z))
+        obj = np.empty(shape, dtype=dtype)
+
+        # A tile is a slab of whole rows along the 1st axis
+        rows = max(1, tileSize // (shape[1] * shape[2]))
+        points = np.empty((rows,) + shape[1:] + (3,))
+        points[..., 0] = step_x[None, :, None]
+        points[..., 2] = step_z[None, None, :]
+        for start in range(0, shape[0], rows):
+            stop = min(start + rows, shape[0])
+            tilePoints = points[:stop - start]
+            tilePoints[..., 1] = step_y[start:stop, None, None]
+            obj[start:stop] = self.evaluateRBF(
+                vector, data, tilePoints.reshape(-1, 3), chunkSize,
+                treecode=treecode).reshape(
+                (stop - start,) + shape[1:])
 
-        obj = poly + radial  # type 'numpy.ndarray'
         logging.debug("obj.shape: " + str(obj.shape))
         logging.debug("Type of obj: " + str(type(obj)))
 
         return obj, spacing
 
+    def getFittedImage(self, vector, data, offset=[0, 0, 0]):
+        """
+        `radialBasisFunc` of a block as a `vtkImageData` placed in the space
+        of the coords: its x, y and z are the columns 0, 1 and 2 of `data`.
+        The origin and spacing are those of the sample positions.
+        @param vector       found fitting
+        @param data         point_num*3 array, coords of the block
+        @param offset       position of the block, added to the origin
+        @return vtkImageData
+        """
+        obj, _ = self.radialBasisFunc(vector, data)
+
+        # The same sample positions as `radialBasisFunc`
+        axes, _ = self._getSampleGrid(data, self.setStep())
+        origin = [a[0] + o for a, o in zip(axes, offset)]
+        spacing = [a[1] - a[0] if len(a) > 1 else 1.0 for a in axes]
+
+        # [y, x, z] of `np.meshgrid` --> [z, y, x] of VTK
+        return self.vtkImageDataFromNdarray(
+            np.ascontiguousarray(obj.transpose(2, 0, 1)), spacing, origin)
+
+    def _getLatticeValues(self, vector, data, shape):
+        """
+        The fitting at the voxel lattice of a block
+        @param vector       found fitting
+        @param data         point_num*3 array, coords of the block
+        @param shape        number of nodes along the columns 0, 1 and 2
+        @return ndarray     float32, indexed as the columns of `data`
+        """
+        points = np.indices(shape).reshape(3, -1).T
+        return self.evaluateRBF(vector, data, points).astype(np.float32).reshape(shape)
+
+    def getBlockSurfaces(self, blocks, step=[40] * 3, value=0.0, processes=None):
+        """
+        Contour the fitting of every block on the global voxel lattice
+        - every block is sampled on its own nodes of the lattice, on a
+          thread pool
+        - every block is contoured by flying edges (marching cubes before
+          VTK 7) over its nodes and the first layer of nodes of its upper
+          neighbours, one voxel of overlap. A node shared by blocks has the
+          value of one of them in all, so neighbouring blocks have the same
+          vertices on their shared face
+        @param blocks       a list of (vector, coords, offset), offset is the
+                            origin of the block, see `BlockPointStore.getOrigin`
+        @param step         shape of the blocks
+        @param value        iso-value of the surface
+        @param processes    number of threads, all cores by default
+        @return list        a `vtkPolyData` per block, in the order of `blocks`
+        """
+        step = np.asarray(step, dtype=int)
+
+        def sample(block):
+            vector, coords, offset = block
+            return self._getLatticeValues(vector, coords, tuple(step + 1))
+
+        def contour(index, offset):
+            # A node on a face, edge or corner of the block is shared with
+            # the neighbours there. All of them take its value from the same
+            # block, the fitted one of the greatest index, so they have the
+            # same vertices on the seams.
+            values = lattices[index].copy()
+            for parts in itertools.product(range(3), repeat=3):  # first, inner, last
+                best = None
+                for upper in itertools.product(*[((-1, 0), (0,), (0, 1))[p] for p in parts]):
+                    if tuple(np.add(index, upper)) in lattices:
+                        best = upper  # the last one is the greatest
+                if not any(best):
+                    continue
+                target = [(slice(0, 1), slice(1, s), slice(s, s + 1))[p]
+                          for p, s in zip(parts, step)]
+                source = tuple(slice(t.start - u * s, t.stop - u * s)
+                               for t, u, s in zip(target, best, step))
+                values[tuple(target)] = lattices[tuple(np.add(index, best))][source]
+
+            # Columns 0, 1 and 2 of the coords --> x, y and z of VTK
+            imageData = self.vtkImageDataFromNdarray(
+                np.ascontiguousarray(values.transpose(2, 1, 0)), [1, 1, 1], offset)
+            if hasattr(vtk, 'vtkFlyingEdges3D'):
+                contourFilter = vtk.vtkFlyingEdges3D()
+            else:
+                contourFilter = vtk.vtkMarchingCubes()
+            contourFilter.SetInputData(imageData)
+            contourFilter.SetValue(0, value)
+            contourFilter.ComputeNormalsOff()
+            contourFilter.ComputeGradientsOff()
+            contourFilter.ComputeScalarsOff()
+            contourFilter.Update()
+            return contourFilter.GetOutput()
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        startTime = time.time()
+        blocks = list(blocks)
+        offsets = [np.asarray(offset, dtype=np.float64) for _, _, offset in blocks]
+        indices = [tuple(np.round(offset / step).astype(int)) for offset in offsets]
+        pool = ThreadPool(processes) if processes > 1 and len(blocks) > 1 else None
+        try:
+            mapper = pool.map if pool is not None else map
+            lattices = dict(zip(indices, mapper(sample, blocks)))
+            surfaces = list(mapper(lambda args: contour(*args), zip(indices, offsets)))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        logging.debug("--- contour of %d blocks uses %s seconds ---" %
+                      (len(blocks), time.time() - startTime))
+
+        return surfaces
+
+    def contourBlocks(self, blocks, step=[40] * 3, value=0.0, processes=None,
+                      tolerance=None):
+        """
+        Extract the fitted surface of many blocks into one polydata: the
+        surfaces of `getBlockSurfaces` are appended, the vertices of the
+        seams are welded, and the normals are computed once.
+        Usage:
+            ```
+            blocks = [(vectors[sn], pointStore.getCoords(sn), pointStore.getOrigin(sn))
+                      for sn in vectors]
+            polyData = logic.contourBlocks(blocks, step)
+            ```
+        @param blocks       see `getBlockSurfaces`
+        @param step         shape of the blocks
+        @param value        iso-value of the surface
+        @param processes    number of threads, all cores by default
+        @param tolerance    distance under which vertices are welded,
+                            only the coincident ones by default
+        @return vtkPolyData     with point normals
+        """
+        surfaces = self.getBlockSurfaces(blocks, step, value, processes)
+
+        startTime = time.time()
+        append = vtk.vtkAppendPolyData()
+        for surface in surfaces:
+            append.AddInputData(surface)
+
+        clean = vtk.vtkCleanPolyData()
+        clean.SetInputConnection(append.GetOutputPort())
+        clean.PointMergingOn()
+        if tolerance is not None:
+            clean.ToleranceIsAbsoluteOn()
+            clean.SetAbsoluteTolerance(tolerance)
+
+        normals = vtk.vtkPolyDataNormals()
+        normals.SetInputConnection(clean.GetOutputPort())
+        normals.SplittingOff()
+        normals.ConsistencyOn()
+        normals.Update()
+        logging.debug("--- merging %d blocks uses %s seconds ---" %
+                      (len(surfaces), time.time() - startTime))
+
+        return normals.GetOutput()
+
+    def radialBasisFuncNarrowBand(self, vector, data, step=0.1, coarseStep=4,
+                                  dtype=np.float32):
+        """
+        `radialBasisFunc` evaluated in full only near the zero level set.
+        A coarse grid of every `coarseStep` nodes is evaluated first, then only
+        the coarse cells whose corners change sign, and their neighbours, are
+        refined to full resolution. Elsewhere a node takes the value of its
+        nearest coarse node, which has the sign of the whole cell, so the
+        output can go to `vtkContourFilter` with value 0 as before.
+        NOTE: only the evaluation is narrow band, the output is still the
+        dense grid of `radialBasisFunc`, not a sparse or blocked one, so it
+        takes the same memory.
+        @param vector       found fitting
+        @param data         point_num*3 array, every row is a 3D point
+        @param coarseStep   nodes between two coarse nodes along every axis
+        @return1            a ndarray object in ndarray format, the same grid
+                            as `radialBasisFunc`
+        @return2            spacing
+        """
+        step = self.setStep()
+        (step_x, step_y, step_z), spacing = self._getSampleGrid(data, step)
+        positions = (step_y, step_x, step_z)  # indexed as `np.meshgrid`: [y, x, z]
+        shape = tuple(len(p) for p in positions)
+
+        def evaluate(indices):
+            points = np.column_stack([p[i] for p, i in zip((step_x, step_y, step_z),
+                                                           (indices[1], indices[0],
+                                                            indices[2]))])
+            return self.evaluateRBF(vector, data, points)
+
+        # Coarse nodes along every axis, always including the last node
+        coarse = [np.unique(np.append(np.arange(0, n, coarseStep), n - 1))
+                  for n in shape]
+        coarseValues = evaluate([i.ravel() for i in np.meshgrid(
+            *coarse, indexing='ij')]).reshape([len(c) for c in coarse])
+
+        # Coarse cells whose 8 corners do not all have the same sign
+        corners = [coarseValues[a:a + coarseValues.shape[0] - 1,
+                                b:b + coarseValues.shape[1] - 1,
+                                c:c + coarseValues.shape[2] - 1]
+                   for a in (0, 1) for b in (0, 1) for c in (0, 1)]
+        isBand = (np.min(corners, axis=0) <= 0) & (np.max(corners, axis=0) >= 0)
+
+        # Dilate by one cell, a thin feature can pass between two corners
+        for axis in range(3):
+            dilated = isBand.copy()
+            lower = [slice(None)] * 3
+            upper = [slice(None)] * 3
+            lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+            dilated[tuple(lower)] |= isBand[tuple(upper)]
+            dilated[tuple(upper)] |= isBand[tuple(lower)]
+            isBand = dilated
+
+        # Nearest coarse node of every node, the fill outside the band
+        nearest = [np.searchsorted((c[1:] + c[:-1]) / 2.0, np.arange(n), side='right')
+                   for c, n in zip(coarse, shape)]
+        obj = coarseValues[np.ix_(*nearest)].astype(dtype)
+
+        isRefined = np.zeros(shape, dtype=bool)
+        for a, b, c in np.argwhere(isBand):
+            isRefined[coarse[0][a]:coarse[0][a + 1] + 1,
+                      coarse[1][b]:coarse[1][b + 1] + 1,
+                      coarse[2][c]:coarse[2][c + 1] + 1] = True
+        indices = np.nonzero(isRefined)
+        obj[indices] = evaluate(indices)
+
+        logging.debug("Narrow band: %d + %d of %d nodes evaluated" %
+                      (coarseValues.size, len(indices[0]), obj.size))
+
+        return obj, spacing
+
     def ndarray2vtkImageData(self, numpyArray, castType=0,
                              spacing=[1, 1, 1], origin=[-1, -1, -1]):
         """
@@ -1525,18 +4488,12 @@ class DivideImageLogic(ScriptedLoadableModuleLogic):
             11 - VTK_DOUBLE
         @return vtkImageData
         """
-        # numpy array --> VTK array (vtkFloatArray)
-        vtk_data_array = numpy_support.numpy_to_vtk(
-            num_array=numpyArray.transpose(2, 0, 1).ravel(),
-            deep=True,
-            array_type=vtk.VTK_FLOAT)
-
-        # VTK array (vtkFloatArray) --> vtkImageData
-        img_vtk = vtk.vtkImageData()
-        img_vtk.SetDimensions(numpyArray.shape)
-        img_vtk.SetSpacing(spacing)
-        img_vtk.SetOrigin(origin)  # default numpy origina is [-1, -1, -1]
-        img_vtk.GetPointData().SetScalars(vtk_data_array)  # is a vtkImageData
+        # numpy array --> vtkImageData, one copy for the transpose and the
+        # native dtype is kept. The 2nd axis of `numpyArray` varies fastest
+        # in the copy, so it is the X of the image, as `np.meshgrid` indexes
+        # [y, x, z] in `radialBasisFunc`.
+        img_vtk = self.vtkImageDataFromNdarray(
+            np.ascontiguousarray(numpyArray.transpose(2, 0, 1)), spacing, origin)
 
         # casting
         if castType == 0:  # No casting
@@ -1797,6 +4754,736 @@ class DivideImageTest(ScriptedLoadableModuleTest):
         # print isValidArrayList
         # print np.sum(isValidArrayList)
 
+    def test_getValidBlockGrid(self):
+        """
+        The block grid must agree with `isValidMatrix` on every block,
+        including the ragged ones at the edges.
+        """
+        logic = DivideImageLogic()
+
+        bigMatrix = np.random.randint(80, 110, (47, 33, 29)).astype(np.int16)
+        divideStep = [10, 7, 6]
+
+        isValidGrid, counts = logic.getValidBlockGrid(bigMatrix, divideStep)
+        shape = bigMatrix.shape
+        for i in range(0, shape[0], divideStep[0]):
+            for j in range(0, shape[1], divideStep[1]):
+                for k in range(0, shape[2], divideStep[2]):
+                    subMatrix = bigMatrix[i:i + divideStep[0],
+                                          j:j + divideStep[1],
+                                          k:k + divideStep[2]]
+                    index = (i // divideStep[0], j // divideStep[1], k // divideStep[2])
+                    assert isValidGrid[index] == logic.isValidMatrix(subMatrix)
+
+        view = logic.getBlockView(bigMatrix, divideStep)
+        assert np.may_share_memory(view, bigMatrix)
+        assert np.array_equal(view[1, 2, 3], bigMatrix[10:20, 14:21, 18:24])
+
+        logging.info("test_getValidBlockGrid passed.")
+
+    def test_IntegralVolume(self):
+        """
+        Counts from the integral volume must agree with a direct count,
+        with and without overlap.
+        """
+        logic = DivideImageLogic()
+
+        bigMatrix = np.random.randint(80, 110, (47, 33, 29)).astype(np.int16)
+        integralVolume = logic.getIntegralVolume(bigMatrix)
+        assert logic.getIntegralVolume(bigMatrix) is integralVolume  # cached
+
+        for divideStep in ([10, 7, 6], [12, 12, 12]):
+            isValidGrid, counts = logic.getValidBlockGrid(bigMatrix, divideStep)
+            assert np.array_equal(integralVolume.blockCounts(divideStep)[0], counts)
+            assert np.array_equal(integralVolume.isValidGrid(divideStep), isValidGrid)
+
+        overlap = [2, 2, 2]
+        counts, _ = integralVolume.blockCounts([10, 7, 6], overlap)
+        for extentIndexSn in logic._getSubImageInfo(bigMatrix, [10, 7, 6], overlap):
+            e = extentIndexSn[:6]
+            voi = (e[4], e[5] + 1, e[2], e[3] + 1, e[0], e[1] + 1)
+            subMatrix = bigMatrix[voi[0]:voi[1], voi[2]:voi[3], voi[4]:voi[5]]
+            num = np.sum((subMatrix >= 90) & (subMatrix <= 100))
+            assert counts[extentIndexSn[6:-1]] == num == integralVolume.boxCount(voi)
+
+        logic.clearIntegralVolumes(bigMatrix)
+        assert logic.getIntegralVolume(bigMatrix) is not integralVolume
+
+        logging.info("test_IntegralVolume passed.")
+
+    def test_BlockHistogram(self):
+        """
+        Validity from the block histograms must agree with a rescan,
+        exactly for 8-bit data and for a coarse integer range.
+        """
+        logic = DivideImageLogic()
+        divideStep = [10, 7, 6]
+
+        bigMatrix = np.random.randint(0, 256, (47, 33, 29)).astype(np.uint8)
+        blockHistogram = logic.getBlockHistogram(bigMatrix, divideStep)
+        for valueRange, ratio in (([90, 100], 0.04), ([0, 127], 0.5), ([300, 400], 0.1)):
+            isValidGrid, counts = logic.getValidBlockGrid(bigMatrix, divideStep,
+                                                          valueRange, ratio)
+            assert np.array_equal(blockHistogram.counts(valueRange), counts)
+            assert np.array_equal(blockHistogram.isValidGrid(valueRange, ratio),
+                                  isValidGrid)
+
+        bigMatrix = np.random.randint(-1000, 1000, (47, 33, 29)).astype(np.int16)
+        blockHistogram = logic.getBlockHistogram(bigMatrix, divideStep, numBins=2000)
+        isValidGrid, counts = logic.getValidBlockGrid(bigMatrix, divideStep, [-200, 300])
+        assert np.array_equal(blockHistogram.counts([-200, 300]), counts)
+
+        logging.info("test_BlockHistogram passed.")
+
+    def test_getCoordsStore(self):
+        """
+        Every block of the store must hold the same points as `getCoords`.
+        """
+        logic = DivideImageLogic()
+
+        bigMatrix = np.random.randint(80, 110, (47, 33, 29)).astype(np.int16)
+        divideStep = [10, 7, 6]
+        subMatrices, isValidSubMatrices = logic.getValidSubMatrices(
+            bigMatrix, divideStep)
+
+        pointStore = logic.getCoordsStore(bigMatrix, divideStep)
+        assert len(pointStore) == len(subMatrices)
+        assert np.array_equal(pointStore.isValid(), isValidSubMatrices)
+        for sn, subMatrix in enumerate(subMatrices):
+            if isValidSubMatrices[sn]:
+                assert np.array_equal(pointStore.getCoords(sn),
+                                      logic.getCoords(subMatrix))
+
+        logging.info("test_getCoordsStore passed.")
+
+    def test_implicitFittingSolver(self):
+        """
+        The LU solve must give the same fitting as the pinv of `patella.txt`.
+        """
+        logic = DivideImageLogic()
+
+        text_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "patella.txt")
+        data = np.loadtxt(text_file)
+
+        vectors = []
+        for solver in ('pinv', 'solve'):
+            np.random.seed(0)  # the same `k` of the ellipsoid constraint
+            startTime = time.time()
+            vector = logic.implicitFitting(data, solver=solver)
+            logging.info("--- implicitFitting with %s uses %s seconds ---" %
+                         (solver, time.time() - startTime))
+            vector = vector.real / np.sign(vector.real[np.argmax(np.abs(vector.real))])
+            vectors.append(vector)
+
+        assert np.allclose(vectors[0], vectors[1], rtol=1e-6, atol=1e-9)
+
+        # A float32 system must be accepted by the LU solve, not fall back
+        pinvCalls = []
+        pinv = np.linalg.pinv
+
+        def countedPinv(a, *args, **kwargs):
+            pinvCalls.append(a.dtype)
+            return pinv(a, *args, **kwargs)
+
+        np.linalg.pinv = countedPinv
+        try:
+            np.random.seed(0)
+            vector = logic.implicitFitting(data, dtype=np.float32)
+        finally:
+            np.linalg.pinv = pinv
+        assert not pinvCalls
+        vector = vector.real / np.sign(vector.real[np.argmax(np.abs(vector.real))])
+        assert np.allclose(vector, vectors[1], rtol=0, atol=1e-4 * np.abs(vectors[1]).max())
+
+        logging.info("test_implicitFittingSolver passed.")
+
+    def test_fitBlocks(self):
+        """
+        Fitting on a process pool must give the same vectors as in this process.
+        """
+        logic = DivideImageLogic()
+
+        bigMatrix = np.random.randint(80, 110, (30, 30, 30)).astype(np.int16)
+        divideStep = [10] * 3
+        pointStore = logic.getCoordsStore(bigMatrix, divideStep)
+        blocks = [(sn, logic.decimateCoords(pointStore.getCoords(sn), 60, method='grid')[0])
+                  for sn in np.flatnonzero(pointStore.isValid())]
+        assert len(blocks) > 4
+
+        serial = dict(logic.fitBlocks(blocks, processes=0, seed=0))
+        pooled = dict(logic.fitBlocks(blocks, processes=2, seed=0))
+        streamed = dict(logic.fitBlocks(iter(blocks), processes=2, seed=0))
+
+        # Leaving early ends the pool, its task thread is not left waiting
+        fittings = logic.fitBlocks(iter(blocks * 8), processes=2, seed=0)
+        sn, vector = next(fittings)
+        fittings.close()
+        assert np.allclose(vector, serial[sn], rtol=1e-10, atol=1e-12)
+
+        assert sorted(serial) == [sn for sn, coords in blocks]
+        for results in (pooled, streamed):
+            assert sorted(results) == sorted(serial)
+            for sn in serial:
+                assert np.allclose(results[sn], serial[sn], rtol=1e-10, atol=1e-12)
+
+        logging.info("test_fitBlocks passed.")
+
+    def test_radialBasisFuncNarrowBand(self):
+        """
+        The narrow band must have the signs of the full evaluation everywhere,
+        and its values near the surface.
+        """
+        logic = DivideImageLogic()
+
+        # A spherical shell of radius 14 voxels
+        grid = np.indices((40, 40, 40)) - 19.5
+        radius = np.sqrt((grid ** 2).sum(0))
+        bigMatrix = np.where(np.abs(radius - 14) < 0.6, 95, 0).astype(np.int16)
+        data = logic.decimateCoords(np.argwhere(bigMatrix), 200)[0]
+        vector = logic.implicitFitting(data)
+
+        fullValues, fullSpacing = logic.radialBasisFunc(vector, data)
+        bandValues, bandSpacing = logic.radialBasisFuncNarrowBand(vector, data)
+        assert bandValues.shape == fullValues.shape
+        assert np.allclose(bandSpacing, fullSpacing)
+        assert np.array_equal(np.sign(bandValues), np.sign(fullValues))
+        assert np.any(bandValues != fullValues)  # some nodes are coarse
+
+        # The nodes next to a sign change are evaluated in full
+        isSurface = np.zeros(fullValues.shape, dtype=bool)
+        for axis in range(3):
+            lower = [slice(None)] * 3
+            upper = [slice(None)] * 3
+            lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+            change = np.sign(fullValues[tuple(lower)]) != np.sign(fullValues[tuple(upper)])
+            isSurface[tuple(lower)] |= change
+            isSurface[tuple(upper)] |= change
+        assert isSurface.any()
+        assert np.allclose(bandValues[isSurface], fullValues[isSurface],
+                           rtol=1e-5, atol=1e-6 * np.abs(fullValues).max())
+
+        logging.info("test_radialBasisFuncNarrowBand passed.")
+
+    def test_fitPartitionOfUnity(self):
+        """
+        The blended fits of a spherical shell must have one sign outside it,
+        and every pair of neighbouring fits must agree on their shared data.
+        """
+        logic = DivideImageLogic()
+
+        grid = np.indices((40, 40, 40)) - 19.5
+        radius = np.sqrt((grid ** 2).sum(0))
+        bigMatrix = np.where(np.abs(radius - 12) <= 1.5, 95, 0).astype(np.int16)
+
+        np.random.seed(0)
+        pouFit = logic.fitPartitionOfUnity(bigMatrix, [10] * 3, [2] * 3, ratio=0.02,
+                                           maxPoints=200, processes=0)
+        assert len(pouFit) > 8
+
+        for index in np.argwhere(pouFit.fitIds >= 0):
+            for axis in range(3):
+                neighbour = index.copy()
+                neighbour[axis] += 1
+                if neighbour[axis] < pouFit.grid[axis] and pouFit.fitIds[tuple(neighbour)] >= 0:
+                    assert pouFit._getAgreement(pouFit.fitIds[tuple(index)],
+                                                pouFit.fitIds[tuple(neighbour)]) >= 0
+
+        # A band of 1.5 voxels just outside the shell
+        outside = np.argwhere((radius > 13.5) & (radius < 15))
+        values = pouFit.evaluate(outside)
+        values = values[~np.isnan(values)]
+        assert len(values) > len(outside) / 2
+        assert np.all(values > 0)
+
+        logging.info("test_fitPartitionOfUnity passed.")
+
+    def test_RBFTreecode(self):
+        """
+        The treecode must stay within its tolerance of the exact evaluation,
+        on `patella.txt` and on a synthetic 100k-point cloud.
+        """
+        logic = DivideImageLogic()
+        tolerance = 1e-2
+
+        text_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 "patella.txt")
+        data = np.loadtxt(text_file)
+        weights = np.real(logic.implicitFitting(data)).ravel()[:-10]
+        points = data.min(0) + np.random.rand(20000, 3) * np.ptp(data, axis=0)
+
+        centres = np.random.rand(100000, 3)
+        cloudWeights = np.random.standard_normal(100000)
+        cloudPoints = np.random.rand(20000, 3)
+
+        for name, centres, weights, points in (
+                ("patella.txt", data, weights, points),
+                ("100k points", centres, cloudWeights, cloudPoints)):
+            vector = np.append(weights, np.zeros(10))
+
+            startTime = time.time()
+            exact = logic.evaluateRBF(vector, centres, points)
+            exactTime = time.time() - startTime
+
+            startTime = time.time()
+            treecode = RBFTreecode(centres, weights, tolerance)
+            approximate = logic.evaluateRBF(vector, centres, points, treecode=treecode)
+            treecodeTime = time.time() - startTime
+
+            bound = tolerance * np.abs(weights).sum() * np.sqrt(3) * np.ptp(centres)
+            error = np.abs(approximate - exact).max()
+            logging.info("%s: treecode %.3fs, exact %.3fs, speed-up %.1fx, error %g" %
+                         (name, treecodeTime, exactTime, exactTime / treecodeTime, error))
+            assert error <= bound
+
+        logging.info("test_RBFTreecode passed.")
+
+    def test_getSubImageBlocks(self):
+        """
+        The bulk splitter must give the same sub-images as `vtkExtractVOI`
+        """
+        logic = DivideImageLogic()
+
+        source = vtk.vtkRTAnalyticSource()
+        source.SetWholeExtent(0, 80, 0, 60, 0, 70)
+        source.Update()
+        bigImageData = source.GetOutput()
+        logic.imageData = bigImageData
+
+        for step, overlap in (([10] * 3, [0] * 3), ([12, 9, 7], [2, 1, 2])):
+            startTime = time.time()
+            subImages, blockInfo = logic.getSubImageBlocks(bigImageData, step, overlap)
+            logging.info("--- getSubImageBlocks uses %s seconds ---" % (time.time() - startTime))
+
+            startTime = time.time()
+            extractedImages = [logic._getSubImage(i) for i in
+                               logic._getSubImageInfo(bigImageData, step, overlap)]
+            logging.info("--- vtkExtractVOI uses %s seconds ---" % (time.time() - startTime))
+
+            assert len(subImages) == len(extractedImages)
+            for subImage, extractedImage in zip(subImages, extractedImages):
+                assert subImage.GetExtent() == extractedImage.GetExtent()
+                assert subImage.GetOrigin() == extractedImage.GetOrigin()
+                assert subImage.GetSpacing() == extractedImage.GetSpacing()
+                assert np.array_equal(logic.getNdarray(subImage),
+                                      logic.getNdarray(extractedImage))
+
+            # The last block has no posterior neighbour, its anterior one is sn - 1
+            assert blockInfo.neighbours[-1, 5] == -1
+            assert blockInfo.neighbours[-1, 4] == blockInfo.sns[-1] - 1
+
+        logging.info("test_getSubImageBlocks passed.")
+
+    def test_iterSubImages(self):
+        """
+        Streamed blocks in any order must be the blocks of `getSubImageList`
+        """
+        logic = DivideImageLogic()
+
+        # Consecutive blocks of a Hilbert order are face neighbours
+        grid = (8, 8, 8)
+        indices = np.transpose(np.unravel_index(logic.getBlockOrder(grid, 'hilbert'), grid))
+        assert np.all(np.abs(np.diff(indices, axis=0)).sum(1) == 1)
+
+        source = vtk.vtkRTAnalyticSource()
+        source.SetWholeExtent(0, 80, 0, 60, 0, 70)
+        source.Update()
+        bigImageData = source.GetOutput()
+        step, overlap = [12, 9, 7], [2, 1, 2]
+
+        subImages = logic.getSubImageList(bigImageData, step, overlap)
+        for order in ('raster', 'morton', 'hilbert'):
+            streamed = list(logic.iterSubImages(bigImageData, step, overlap, order, prefetch=3))
+            assert sorted(i.sn for i in streamed) == range(len(subImages))
+            for subImage in streamed:
+                expected = subImages[subImage.sn]
+                assert subImage.index == expected.index
+                assert subImage.neighbours == expected.neighbours
+                assert subImage.GetExtent() == expected.GetExtent()
+                assert np.array_equal(logic.getNdarray(subImage), logic.getNdarray(expected))
+
+        # Leaving a stream early stops its reader
+        stream = logic.iterSubMatrices(bigImageData, step, overlap)
+        next(stream)
+        stream.close()
+
+        logging.info("test_iterSubImages passed.")
+
+    def test_openVolume(self):
+        """
+        A raw NRRD volume, detached or attached, is memory-mapped and
+        divided like the same volume in memory
+        """
+        logic = DivideImageLogic()
+        directory = tempfile.mkdtemp()
+        try:
+            bigMatrix = (np.random.rand(60, 70, 80) * 200).astype('>i2')
+            bigMatrix.tofile(os.path.join(directory, "volume.raw"))
+            with open(os.path.join(directory, "volume.nhdr"), 'w') as f:
+                f.write("NRRD0004\ntype: short\ndimension: 3\nsizes: 80 70 60\n"
+                        "space directions: (0.5,0,0) (0,0.5,0) (0,0,2)\n"
+                        "endian: big\nencoding: raw\ndata file: volume.raw\n")
+            with open(os.path.join(directory, "volume.nrrd"), 'wb') as f:
+                f.write(b"NRRD0004\ntype: float\ndimension: 3\nsizes: 80 70 60\n"
+                        b"endian: little\nencoding: raw\n\n")
+                bigMatrix.astype('<f4').tofile(f)
+
+            header = logic.readNrrdHeader(os.path.join(directory, "volume.nhdr"))
+            assert header.spacing == [0.5, 0.5, 2.0]
+
+            for fileName in ("volume.nhdr", "volume.nrrd"):
+                filePath = os.path.join(directory, fileName)
+                volume = logic.getNdarray(filePath)
+                assert isinstance(volume, np.memmap)
+                assert np.array_equal(volume, bigMatrix)
+
+                isValidGrid, counts = logic.getValidBlockGrid(filePath, [16] * 3, [90, 100])
+                expected = logic.getValidBlockGrid(bigMatrix, [16] * 3, [90, 100])[1]
+                assert np.array_equal(counts, expected)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        logging.info("test_openVolume passed.")
+
+    def test_BlockStore(self):
+        """
+        A reopened `BlockStore` serves its blocks, coords and fits from disk
+        """
+        logic = DivideImageLogic()
+        root = tempfile.mkdtemp()
+        try:
+            bigMatrix = (np.random.rand(60, 70, 80) * 200).astype(np.int16)
+            step, range = [20] * 3, [90, 100]
+
+            blockStore = logic.getBlockStore(bigMatrix, step, root=root)
+            assert np.array_equal(blockStore.getBlock(5), bigMatrix[0:20, 20:40, 20:40])
+            assert np.array_equal(blockStore.isValid(range, 0.05),
+                                  logic.getValidBlockGrid(bigMatrix, step, range, 0.05)[0].ravel())
+
+            startTime = time.time()
+            vectors = blockStore.fitValid(range, 0.05, processes=0)
+            logging.info("--- fitValid uses %s seconds ---" % (time.time() - startTime))
+
+            # The same volume, step and overlap is the same store, no volume is
+            # needed to read it back
+            assert logic.getBlockStore(bigMatrix.copy(), step, root=root).path == blockStore.path
+            reopened = BlockStore(blockStore.path)
+            startTime = time.time()
+            storedVectors = reopened.fitValid(range, 0.05, processes=0)
+            logging.info("--- fitValid of the reopened store uses %s seconds ---" %
+                         (time.time() - startTime))
+            assert sorted(storedVectors) == sorted(vectors)
+            for sn in vectors:
+                assert np.array_equal(storedVectors[sn], vectors[sn])
+
+            # Another overlap is another store
+            overlapStore = logic.getBlockStore(bigMatrix, step, [2] * 3, root=root)
+            assert overlapStore.path != blockStore.path
+            coords = overlapStore.getCoords(0, range)
+            subMatrix = bigMatrix[:22, :22, :22]
+            assert np.array_equal(coords, np.transpose(
+                ((subMatrix >= range[0]) & (subMatrix <= range[1])).nonzero()))
+
+            # An in-place edit is a new content, so a new store
+            bigMatrix[:] = 95
+            editedStore = logic.getBlockStore(bigMatrix, step, root=root)
+            assert editedStore.path != blockStore.path
+            assert editedStore.getCounts(range).sum() == bigMatrix.size
+
+            # So is a new payload of a detached header, the header unchanged
+            bigMatrix.tofile(os.path.join(root, "volume.raw"))
+            headerPath = os.path.join(root, "volume.nhdr")
+            with open(headerPath, 'w') as f:
+                f.write("NRRD0004\ntype: short\ndimension: 3\nsizes: 80 70 60\n"
+                        "endian: little\nencoding: raw\ndata file: volume.raw\n")
+            fileStore = logic.getBlockStore(headerPath, step, root=root)
+            assert fileStore.path == editedStore.path
+            rawPath = os.path.join(root, "volume.raw")
+            (bigMatrix + 1).tofile(rawPath)
+            mtime = os.path.getmtime(rawPath) + 1  # a later write, even with coarse timestamps
+            os.utime(rawPath, (mtime, mtime))
+            assert logic.getBlockStore(headerPath, step, root=root).path != fileStore.path
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+        logging.info("test_BlockStore passed.")
+
+    def test_ResultCache(self):
+        """
+        `implicitFitting` is memoised by content, in memory and on disk
+        """
+        logic = DivideImageLogic()
+        resultCache = DivideImageLogic.resultCache
+        diskDir = tempfile.mkdtemp()
+        try:
+            text_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     "patella.txt")
+            data = np.loadtxt(text_file)
+            k = 100  # a random `k` is a different fitting, not a cache hit
+            vectorSize = logic.implicitFitting(data, k=k).nbytes
+
+            # Room for two vectors in memory
+            cache = ResultCache(2 * vectorSize, diskDir)
+            DivideImageLogic.resultCache = cache
+
+            vector = logic.implicitFitting(data, k=k)
+            assert np.array_equal(logic.implicitFitting(data.copy(), k=k), vector)
+            assert (cache.hits, cache.misses) == (1, 1)
+
+            vector[:] = 0  # a result is a copy, the cache is intact
+            assert np.any(logic.implicitFitting(data, k=k))
+
+            logic.implicitFitting(data, k=k + 1)
+            assert cache.misses == 2
+
+            logic.implicitFitting(data[::2], k=k)
+            assert cache.evictions == 1 and cache.stats.numItems == 2
+
+            # The evicted one comes back from the disk tier
+            logic.implicitFitting(data, k=k)
+            assert cache.diskHits == 1
+            logging.info("ResultCache stats: %s" % cache.stats)
+        finally:
+            DivideImageLogic.resultCache = resultCache
+            shutil.rmtree(diskDir, ignore_errors=True)
+
+        logging.info("test_ResultCache passed.")
+
+    def test_BlockLayout(self):
+        """
+        Curve numbering round-trips, keeps the neighbours and the blocks
+        """
+        logic = DivideImageLogic()
+        shape, step = (53, 47, 61), [10, 12, 8]
+        bigMatrix = (np.random.rand(*shape) * 100).astype(np.float32)
+        rasterInfo = logic.getBlockInfo(shape, step)
+
+        for order in ('morton', 'hilbert'):
+            layout = BlockLayout(rasterInfo.grid, order)
+            sns = np.arange(len(layout))
+            assert np.array_equal(layout.encode(layout.decode(sns)), sns)
+
+            blockInfo = logic.getBlockInfo(shape, step, order=order)
+            assert np.array_equal(blockInfo.vois, rasterInfo.vois[layout.rasterOf])
+            assert np.array_equal(blockInfo.neighbours, layout.neighbours)
+            hasInferior = blockInfo.neighbours[:, 1] >= 0
+            assert np.all(blockInfo.indices[blockInfo.neighbours[hasInferior, 1]] -
+                          blockInfo.indices[hasInferior] == [1, 0, 0])
+
+            blocks, layout = logic.getBlockArray(bigMatrix, step, order)
+            assert blocks.flags.c_contiguous
+            for sn in (0, len(layout) // 2, len(layout) - 1):
+                voi = blockInfo.vois[sn]
+                block = bigMatrix[voi[0]:voi[1], voi[2]:voi[3], voi[4]:voi[5]]
+                assert np.array_equal(blocks[sn][:block.shape[0], :block.shape[1],
+                                                 :block.shape[2]], block)
+
+        logging.info("test_BlockLayout passed.")
+
+    def test_BlockRegistry(self):
+        """
+        Vectorised queries of a `BlockRegistry`
+        """
+        logic = DivideImageLogic()
+        bigMatrix = (np.random.rand(90, 100, 110) * 200).astype(np.int16)
+        bigMatrix[:40] = 95  # the blocks of the first 4 slabs are valid
+        step, range = [10] * 3, [90, 100]
+
+        registry = logic.getBlockRegistry(bigMatrix, step, range=range, ratio=0.2)
+        isValidGrid, counts = logic.getValidBlockGrid(bigMatrix, step, range, 0.2)
+        assert np.array_equal(registry.isValid, isValidGrid.ravel())
+        assert np.array_equal(registry.records['numPoints'], counts.ravel())
+
+        # The last valid slab borders on the invalid ones
+        borderSns = registry.getBorderBlocks()
+        assert np.all(registry[borderSns]['index'][:, 0] == 3)
+        assert len(borderSns) == 10 * 11
+        assert len(registry.getIsolatedBlocks()) == 0
+
+        # Overlapped blocks in a curve order are counted by `IntegralVolume`
+        registry = logic.getBlockRegistry(bigMatrix, step, [2] * 3, range, 0.2, 'hilbert')
+        voi = registry[7]['voi']
+        subMatrix = bigMatrix[voi[0]:voi[1], voi[2]:voi[3], voi[4]:voi[5]]
+        assert registry[7]['numPoints'] == np.sum((subMatrix >= 90) & (subMatrix <= 100))
+
+        logging.info("test_BlockRegistry passed.")
+
+    def test_addPoints(self):
+        """
+        100k points are one actor over the coords array, not a copy of it
+        """
+        vtkLogic = DivideImageVTKLogic(False)
+        coords = np.random.rand(100000, 3).astype(np.float32) * 100
+
+        for mode in ('glyph', 'sprite'):
+            startTime = time.time()
+            actor = vtkLogic.addPoints(coords, scalars=coords[:, 0], mode=mode)
+            logging.info("--- addPoints of %d points by %s uses %s seconds ---" %
+                         (len(coords), mode, time.time() - startTime))
+            assert vtkLogic.numActor == vtkLogic.numActorInit + 1
+
+            polyData = actor.GetMapper().GetInput()
+            points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+            assert np.shares_memory(points, coords)
+            vtkLogic.clearActors()
+
+        logging.info("test_addPoints passed.")
+
+    def test_MultiBlockVolume(self):
+        """
+        The level of every block follows its size on the screen
+        """
+        logic = DivideImageLogic()
+        vtkLogic = DivideImageVTKLogic(False)
+
+        source = vtk.vtkRTAnalyticSource()
+        source.SetWholeExtent(0, 79, 0, 79, 0, 79)
+        source.Update()
+        subImages = logic.getSubImageList(source.GetOutput(), [40] * 3)
+
+        pyramid = vtkLogic.getImagePyramid(subImages[0], 3)
+        assert [i.GetDimensions() for i in pyramid] == [(40, 40, 40), (20, 20, 20), (10, 10, 10)]
+
+        volumes = vtkLogic.addMultiBlockVolume(subImages, vtk.vtkVolumeProperty(), 3)
+        camera = vtkLogic.renderer.GetActiveCamera()
+        camera.SetFocalPoint(40, 40, 40)
+        camera.SetPosition(40, 40, 100)
+        assert np.all(volumes.selectLevels() == 0)
+        assert np.all(volumes.selectLevels(isInteracting=True) == 1)
+        camera.SetPosition(40, 40, 20000)
+        assert np.all(volumes.selectLevels() == 2)
+
+        volumes.remove()
+        assert vtkLogic.renderer.GetVolumes().GetNumberOfItems() == 0
+
+        logging.info("test_MultiBlockVolume passed.")
+
+    def test_TransferFuncCache(self):
+        """
+        `colorfile.csv` is parsed and built once, into the same functions
+        as one `AddRGBPoint` per label
+        """
+        vtkLogic = DivideImageVTKLogic(False)
+        colorFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "colorfile.csv")
+
+        startTime = time.time()
+        transFunc = vtkLogic.getTransferFuncFromFile(colorFile)
+        logging.info("--- getTransferFuncFromFile uses %s seconds ---" % (time.time() - startTime))
+        startTime = time.time()
+        assert vtkLogic.getTransferFuncFromFile(colorFile) is transFunc
+        logging.info("--- cached getTransferFuncFromFile uses %s seconds ---" %
+                     (time.time() - startTime))
+        assert DivideImageVTKLogic(False).getPredefinedTransferFunc(1) is \
+            vtkLogic.getPredefinedTransferFunc(1)
+
+        table = vtkLogic.readColorTable(colorFile)
+        colorFunc = vtk.vtkColorTransferFunction()
+        for label, color in zip(table.labels, table.colors):
+            colorFunc.AddRGBPoint(label, *color)
+        assert transFunc[0].GetSize() == len(table.labels)
+        for value in np.linspace(table.labels[0], table.labels[-1], 97):
+            assert np.allclose(transFunc[0].GetColor(value), colorFunc.GetColor(value))
+        assert transFunc[1].GetValue(0) == 0.0 and transFunc[1].GetValue(table.labels[1]) == 0.25
+
+        logging.info("test_TransferFuncCache passed.")
+
+    def test_LabelMapVolume(self):
+        """
+        Labels keep their own colour up to their bin edges, and can be hidden
+        """
+        vtkLogic = DivideImageVTKLogic(False)
+        colorFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "colorfile.csv")
+        table = vtkLogic.readColorTable(colorFile)
+        labelMap = np.random.randint(0, 150, (20, 30, 40)).astype(np.uint8)
+
+        labelMapVolume = vtkLogic.addLabelMapVolume(labelMap, colorFile, opacity=0.5)
+        for value, label in ((1.0, 1), (1.4, 1), (1.6, 2), (2.0, 2)):
+            assert np.allclose(labelMapVolume.colorFunc.GetColor(value), table.colors[label])
+        assert labelMapVolume.opacityFunc.GetValue(0) == 0.0
+        assert labelMapVolume.opacityFunc.GetValue(1) == 0.5
+
+        labelMapVolume.setVisible([1, 2], False)
+        assert labelMapVolume.opacityFunc.GetValue(2) == 0.0
+        assert labelMapVolume.opacityFunc.GetValue(3) == 0.5
+
+        lookupTable = labelMapVolume.lookupTable
+        assert lookupTable.GetNumberOfTableValues() == table.labels.max() + 1
+        assert np.allclose(lookupTable.GetTableValue(3)[:3], table.colors[3])
+        assert lookupTable.GetTableValue(2)[3] == 0.0
+
+        # Negative labels are offset in the lookup table
+        labelMapVolume = LabelMapVolume(vtk.vtkImageData(), [-2, 0, 3],
+                                        [[1, 0, 0], [0, 0, 0], [0, 0, 1]])
+        lookupTable = labelMapVolume.lookupTable
+        assert lookupTable.GetNumberOfTableValues() == 6
+        assert np.allclose(lookupTable.GetTableValue(lookupTable.GetIndex(-2)), [1, 0, 0, 1])
+        assert np.allclose(lookupTable.GetTableValue(lookupTable.GetIndex(3)), [0, 0, 1, 1])
+        assert lookupTable.GetTableValue(lookupTable.GetIndex(-1))[3] == 0.0
+
+        logging.info("test_LabelMapVolume passed.")
+
+    def test_contourBlocks(self):
+        """
+        The fitted blocks of a spherical shell make one polydata around the shell
+        """
+        logic = DivideImageLogic()
+
+        z, y, x = np.indices((60, 60, 60))
+        radius = np.sqrt((z - 30) ** 2 + (y - 30) ** 2 + (x - 30) ** 2)
+        bigMatrix = ((radius > 20) & (radius < 22)).astype(np.uint8) * 95
+
+        # A sample of the fitted image is the fitting at its position
+        pointStore = logic.getCoordsStore(bigMatrix, [20] * 3, [90, 100])
+        vectors = dict(logic.fitBlocks(pointStore, processes=0, ratio=0.02))
+        sn = sorted(vectors)[0]
+        coords, offset = pointStore.getCoords(sn), pointStore.getOrigin(sn)
+        imageData = logic.getFittedImage(vectors[sn], coords, offset)
+        position = np.add(imageData.GetOrigin(), np.multiply(imageData.GetSpacing(), [2, 3, 1]))
+        assert np.isclose(logic.getNdarray(imageData)[1, 3, 2],
+                          logic.evaluateRBF(vectors[sn], coords, (position - offset)[None]),
+                          rtol=1e-4)
+
+        step = [20] * 3
+        blocks = [(vectors[blockSn], pointStore.getCoords(blockSn), pointStore.getOrigin(blockSn))
+                  for blockSn in vectors]
+        startTime = time.time()
+        polyData = logic.contourBlocks(blocks, step)
+        logging.info("--- contourBlocks of %d blocks uses %s seconds ---" %
+                     (len(blocks), time.time() - startTime))
+
+        assert polyData.GetNumberOfPolys() > 0
+        assert polyData.GetPointData().GetNormals() is not None
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        distances = np.linalg.norm(points - 30, axis=1)
+        assert 18 < np.median(distances) < 24
+
+        # The seam vertices are welded, fewer than those of the blocks
+        numPoints = sum(surface.GetNumberOfPoints()
+                        for surface in logic.getBlockSurfaces(blocks, step))
+        assert polyData.GetNumberOfPoints() < numPoints
+
+        # Open edges are only on the outside of the fitted blocks, none on a seam
+        featureEdges = vtk.vtkFeatureEdges()
+        featureEdges.SetInputData(polyData)
+        featureEdges.BoundaryEdgesOn()
+        featureEdges.FeatureEdgesOff()
+        featureEdges.ManifoldEdgesOff()
+        featureEdges.NonManifoldEdgesOff()
+        featureEdges.Update()
+        isFitted = np.zeros([n + 2 for n in pointStore.grid], dtype=bool)  # padded
+        for _, _, offset in blocks:
+            isFitted[tuple(np.add(offset, step) // step)] = True
+        boundary = featureEdges.GetOutput()
+        if boundary.GetNumberOfPoints():
+            for point in numpy_support.vtk_to_numpy(boundary.GetPoints().GetData()):
+                # The blocks whose extent, with the one voxel of overlap, has the point
+                low = np.ceil(point / step).astype(int) - 1
+                high = np.floor(point / step).astype(int)
+                assert not isFitted[low[0] + 1:high[0] + 2, low[1] + 1:high[1] + 2,
+                                    low[2] + 1:high[2] + 2].all()
+
+        logging.info("test_contourBlocks passed.")
+
     def test_EmptyVolume(self):
         """
         Generate an empty volume